@@ -1,16 +1,26 @@
 #!/usr/bin/env python
 import sys
 import logging
-import pickle
 import os
 import time
+import math
 import yaml
 import signal
 import cmd
+import threading
+import copy
+import glob
+import hashlib
+import json
+import itertools
 sys.path.append('/usr/seer')  # Necessary if this is not already in your python path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'agent', 'modules'))
 
 from testbed import testbed
 from app.logsetup import logSetup
+from safest import collector
+from safest import state
+from safest import bundle
 
 #xrange() stops at 1 less than the second number, so this is 1-5
 DIRECTORIES = [ "directory%i" % i for i in xrange(1,6)]
@@ -24,10 +34,14 @@ class ExperimentConfig():
     REQUIRED_PROPS = ['num_dirs','num_relays','num_clients','template_dir',
                       'thinking_time','file_sizes','socks_address','num_servers',
                       'save_data_location']
-    
-    def __init__(self,filename):
-        f = open(filename, 'r')
-        self.conf = yaml.safe_load(f.read())
+    # Properties left out of a config's identity
+    IGNORED_PROPS = ['description','save_data_location']
+
+    def __init__(self,filename=None,conf=None):
+        if conf is None:
+            f = open(filename, 'r')
+            conf = yaml.safe_load(f.read())
+        self.conf = conf
 
         for prop in ExperimentConfig.REQUIRED_PROPS:
             try:
@@ -36,15 +50,22 @@ class ExperimentConfig():
                 del self
                 raise Exception("Experiment config file missing required property: %s" % e)
 
-    def getProp(self,prop):
-        if prop.find(":") is -1:
-            return self.conf[prop]
-        else:
-            properties = prop.split(":")
-            conf = self.conf
-            for key in properties:
-                conf = conf[key]
-            return conf
+    def getProp(self,prop,*default):
+        """Look up prop ('a:b' descends into nested maps). If a default is
+        given it is returned when the property isn't set"""
+        try:
+            if prop.find(":") is -1:
+                return self.conf[prop]
+            else:
+                properties = prop.split(":")
+                conf = self.conf
+                for key in properties:
+                    conf = conf[key]
+                return conf
+        except (KeyError, TypeError):
+            if default:
+                return default[0]
+            raise
 
     def setProp(self,prop,val):
         self.conf[prop] = val
@@ -52,6 +73,412 @@ class ExperimentConfig():
     def __str__(self):
         return yaml.dump(self.conf)
 
+    def applyAxis(self,axis,value):
+        """Set one sweep axis. Top level properties are set directly,
+        anything else is a Tor option replaced in (or added to) the relay
+        and client option lists"""
+        if axis in self.conf:
+            self.conf[axis] = value
+            return
+        option = "%s %s" % (axis, value)
+        found = False
+        for prop in ['relay_config_options','client_config_options']:
+            opts = self.conf.get(prop) or []
+            for i in xrange(len(opts)):
+                words = opts[i].split(None,1)
+                if words and words[0] == axis:
+                    opts[i] = option
+                    found = True
+            self.conf[prop] = opts
+        if not found:
+            for prop in ['relay_config_options','client_config_options']:
+                self.conf[prop].append(option)
+
+    def expand(self):
+        """Expand the 'sweep' axes and 'replicates' count into one config per
+        run, named <name>-<axis>=<value>...[-r<n>]. Every run starts from a
+        fresh network, so axes are simply taken in name order."""
+        sweep = self.conf.get('sweep') or {}
+        replicates = int(self.conf.get('replicates',1))
+        axes = sorted(sweep)
+        values = [sweep[axis] if isinstance(sweep[axis],list) else [sweep[axis]] for axis in axes]
+
+        confs = []
+        for combo in itertools.product(*values):
+            for replicate in xrange(1,replicates+1):
+                conf = copy.deepcopy(self.conf)
+                conf.pop('sweep',None)
+                conf.pop('replicates',None)
+                if replicates > 1:
+                    conf['replicate'] = replicate
+                run = ExperimentConfig(conf=conf)
+                suffix = ""
+                for (axis,value) in zip(axes,combo):
+                    run.applyAxis(axis,value)
+                    suffix += "-%s=%s" % (axis,value)
+                if replicates > 1:
+                    suffix += "-r%d" % replicate
+                run.name = "%s%s" % (self.name, suffix)
+                confs.append(run)
+        return confs
+
+    def resultsPath(self):
+        """Where torAgent saves this run's results (see results_path there)"""
+        return os.path.join(self.getProp('save_data_location'), testbed.experiment, self.name)
+
+    def canonical(self):
+        """The config as sorted JSON, leaving out what doesn't change the
+        experiment itself"""
+        conf = dict(self.conf)
+        for prop in ExperimentConfig.IGNORED_PROPS:
+            conf.pop(prop,None)
+        return json.dumps(conf,sort_keys=True,separators=(',',':'))
+
+    def identity(self):
+        """Content hash of the canonical config, the Tor binary and the
+        templates it is run with"""
+        h = hashlib.sha1(self.canonical())
+        h.update("tor:%s" % fileDigest(self.getProp('tor_binary',None)))
+        template_dir = self.getProp('template_dir')
+        for template in sorted(glob.glob(os.path.join(template_dir,'*'))):
+            h.update("%s:%s" % (os.path.basename(template), fileDigest(template)))
+        return h.hexdigest()
+
+_digests = dict()
+
+def fileDigest(path):
+    """SHA1 of the file at path, cached while its size and mtime don't change"""
+    if not path or not os.path.isfile(path):
+        return "missing:%s" % path
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime)
+    if key not in _digests:
+        h = hashlib.sha1()
+        f = open(path,'rb')
+        try:
+            for chunk in iter(lambda: f.read(1 << 20), ''):
+                h.update(chunk)
+        finally:
+            f.close()
+        _digests[key] = h.hexdigest()
+    return _digests[key]
+
+class ResultIndex(object):
+    """index.json under save_data_location, recording which config hashes
+    have run and where their results went"""
+
+    STARTED = 'started'
+    COMPLETE = 'complete'
+    FAILED = 'failed'
+
+    def __init__(self,location):
+        self.path = os.path.join(location,'index.json')
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            return json.load(open(self.path))
+        except (IOError, ValueError):
+            return dict()
+
+    def get(self,identity):
+        self.lock.acquire()
+        try:
+            return self.load().get(identity)
+        finally:
+            self.lock.release()
+
+    def isComplete(self,identity):
+        entry = self.get(identity)
+        return entry is not None and entry['status'] == ResultIndex.COMPLETE
+
+    def record(self,identity,name,status,**info):
+        self.lock.acquire()
+        try:
+            index = self.load()
+            entry = index.setdefault(identity,dict())
+            entry.update(info)
+            entry['name'] = name
+            entry['status'] = status
+            entry['updated'] = time.time()
+            parent = os.path.dirname(self.path)
+            if not os.path.exists(parent):
+                os.makedirs(parent)
+            f = open("%s.tmp" % self.path,'w')
+            json.dump(index,f,indent=1,sort_keys=True)
+            f.close()
+            os.rename("%s.tmp" % self.path,self.path)
+        finally:
+            self.lock.release()
+
+NODE_NAMES = {'dirs': 'directory', 'relays': 'router', 'clients': 'client', 'servers': 'server'}
+NODE_KINDS = ['dirs', 'relays', 'clients', 'servers']
+
+def allocatePools(confs,inventory=None):
+    """Split confs into waves of experiments that can run at the same time on
+    disjoint pools of nodes. Each wave is a list of (conf, offsets), where
+    offsets gives how many nodes of each kind come before the experiment's
+    pool. Without an inventory every experiment gets a wave of its own."""
+    if inventory is None:
+        return [[(conf,{})] for conf in confs]
+
+    waves = []
+    pending = list(confs)
+    while pending:
+        used = dict([(kind,0) for kind in NODE_KINDS])
+        wave = []
+        for conf in list(pending):
+            need = dict([(kind,conf.getProp('num_%s' % kind)) for kind in NODE_KINDS])
+            if [kind for kind in NODE_KINDS if used[kind] + need[kind] > inventory[kind]]:
+                continue
+            wave.append((conf,dict(used)))
+            for kind in NODE_KINDS:
+                used[kind] += need[kind]
+            pending.remove(conf)
+        if not wave:
+            raise Exception("Experiment '%s' needs more nodes than are available" % pending[0].name)
+        waves.append(wave)
+    return waves
+
+class RunCancelled(Exception):
+    pass
+
+class ExperimentRun(object):
+    """One experiment running on its own pool of nodes, with its own groups"""
+
+    def __init__(self,runner,conf,offsets=None,pools=1):
+        self.runner = runner
+        self.conf = conf
+        self.offsets = offsets or {}
+        self.pools = pools
+        self.tag = conf.name
+        self.identity = conf.identity()
+        self.index = runner.resultIndex(conf)
+        self.store = runner.state
+        self.run_id = None
+        self.phase = None
+        self.phase_started = None
+        self.cancelled = threading.Event()
+        self.log = runner.log
+        self.collector = runner.collector
+        self.torGroup = None
+        self.webGroup = None
+        self.tcpGroup = None
+        self.bundles = []
+
+    def nodes(self,kind):
+        """The names of the nodes of one kind ('dirs', 'relays', 'clients' or 'servers') in our pool"""
+        offset = self.offsets.get(kind,0)
+        return ["%s%i" % (NODE_NAMES[kind], i) for i in xrange(offset+1,offset+self.conf.getProp('num_%s' % kind)+1)]
+
+    def torNodes(self):
+        return self.nodes('dirs') + self.nodes('relays') + self.nodes('clients')
+
+    def trafficNodes(self):
+        return self.nodes('relays') + self.nodes('clients')
+
+    def setup(self,messaging):
+        """Create our groups and prepare them to run the experiment"""
+        expConf = self.conf
+        self.torGroup = messaging.newGroup('TOR','Tor_%s' % self.tag)
+        self.log.info("Tor Group established")
+        self.webGroup = messaging.newGroup('Socks HTTP',"Web_%s" % self.tag)
+        self.log.info("Web Group established")
+        if expConf.getProp('use_tcp_app',None) is not None:
+            self.tcpGroup = messaging.newGroup("Socks Application", "App_%s" % self.tag)
+        else:
+            self.tcpGroup = None
+
+        dirs = self.nodes('dirs')
+        relays = self.nodes('relays')
+        clients = self.nodes('clients')
+        servers = self.nodes('servers')
+
+        # Everything but the traffic generators' distributions goes out as
+        # one versioned bundle per group, see safest/bundle.py
+        self.version = int(time.time() * 1000)
+        address = self.runner.collectorAddress()
+        self.bundles = []
+
+        self.pushBundle(self.torGroup,'tor',self.torNodes(),{
+            'directory': bundle.NodeList(dirs),
+            'relays': bundle.NodeList(relays),
+            'clients': bundle.NodeList(clients),
+            'run_tag': self.tag,
+            'pools': self.pools,
+            'template_dir': expConf.getProp('template_dir'),
+            'tor_binary': expConf.getProp('tor_binary'),
+            'save_data_dir': expConf.getProp('save_data_location'),
+            'client_config_list': expConf.getProp('client_config_options'),
+            'relay_config_list': expConf.getProp('relay_config_options'),
+            'collector': address,
+            'ship_interval': expConf.getProp('ship_interval',0)})
+
+        self.webGroup.think = expConf.getProp('thinking_time')
+        self.webGroup.sizes = expConf.getProp('file_sizes')
+        self.pushBundle(self.webGroup,'web',clients + servers,{
+            'clients': bundle.NodeList(clients),
+            'servers': bundle.NodeList(servers),
+            'socks_addr': expConf.getProp('socks_address'),
+            'logpath': '/var/lib/tor/',
+            'seed': self.identity,
+            'duration': expConf.getProp('duration',9000),
+            'server_mode': expConf.getProp('server_mode','apache'),
+            'collector': address})
+
+        if self.tcpGroup is not None:
+            self.tcpGroup.think = expConf.getProp('use_tcp_app:thinking_time') 
+            self.pushBundle(self.tcpGroup,'app',clients + servers,{
+                'clients': bundle.NodeList(clients),
+                'servers': bundle.NodeList(servers),
+                'socks_addr': expConf.getProp('socks_address'),
+                'logpath': '/var/lib/tor/',
+                'server_cmd': expConf.getProp("use_tcp_app:server_cmd"),
+                'app_cmd': expConf.getProp("use_tcp_app:client_cmd"),
+                'seed': self.identity,
+                'duration': expConf.getProp('duration',9000),
+                'collector': address})
+        self.log.info("Experiment '%s' set up on %s" % (self.tag, ",".join(dirs + relays + clients + servers)))
+
+    def pushBundle(self,group,name,nodes,values):
+        """Set group's variables in one update. Agents apply it at their next
+        command, or when told to APPLY"""
+        tag = "%s:%s" % (self.tag, name)
+        group.bundle = bundle.encode(self.version,values,tag)
+        self.bundles.append((group,tag,nodes))
+
+    def applyBundles(self,timeout=120):
+        """Have every group apply its bundle and wait for the acknowledgements"""
+        for (group,tag,nodes) in self.bundles:
+            self.collector.clear('bundle',tag)
+            group.APPLY()
+        for (group,tag,nodes) in self.bundles:
+            started = time.time()
+            while True:
+                # Wait in short slices so a cancel doesn't have to sit out the timeout
+                remaining = started + timeout - time.time()
+                acked = self.collector.wait('bundle',nodes,tag=tag,timeout=max(min(remaining,1),0))
+                if len([n for n in nodes if n in acked]) >= len(nodes) or remaining <= 0:
+                    break
+                self.checkCancelled()
+            current = [n for n in acked if acked[n]['version'] == self.version]
+            for node in current:
+                self.store.ack(self.run_id,'configure',node,acked[node])
+            missing = [n for n in nodes if n not in current]
+            if missing:
+                self.log.warning("[%s] No acknowledgement of bundle %s from %s" % (tag, self.version, ",".join(missing)))
+
+    def run(self):
+        """Run the experiment through all of its phases"""
+        conf = self.conf
+        self.index.record(self.identity,self.tag,ResultIndex.STARTED,started=time.time())
+        self.run_id = self.store.start_run(self.tag,self.identity,self.offsets)
+        try:
+            self.log.debug("[%s] Applying variable bundles" % self.tag)
+            self.beginPhase('configure')
+            self.applyBundles(conf.getProp('configure_timeout',120))
+            self.store.finish_phase(self.run_id,'configure')
+            self.log.debug("[%s] Sending RM_CACHE" % self.tag)
+            self.beginPhase('clean')
+            self.stop(cleanup=True)
+            self.waitPhase('clean',self.torNodes(),timeout=conf.getProp('cleanup_timeout',300))
+            self.log.debug("[%s] Sending GEN_KEYS to Tor" % self.tag)
+            self.beginPhase('keys')
+            self.torGroup.GEN_KEYS()
+            self.waitPhase('keys',self.nodes('dirs'),timeout=conf.getProp('keys_timeout',300))
+            self.log.debug("[%s] Sending START to Tor" % self.tag)
+            self.beginPhase('ready')
+            self.torGroup.START()
+            self.waitPhase('ready',self.trafficNodes(),fraction=conf.getProp('ready_fraction',0.9),
+                           timeout=conf.getProp('ready_timeout',900))
+            self.log.debug("[%s] Sending START to Web" % self.tag)
+            self.beginPhase('traffic')
+            self.webGroup.START()
+            if self.tcpGroup:
+                self.tcpGroup.START()
+            duration = conf.getProp('duration',9000)
+            self.log.debug("[%s] Letting it run for %s seconds" % (self.tag, duration))
+            self.cancelled.wait(duration)
+            self.checkCancelled()
+            self.log.debug("[%s] Stopping everything" % self.tag)
+            self.stop()
+            self.store.finish_phase(self.run_id,'traffic')
+            self.log.debug("[%s] Stopped. Saving Data" % self.tag)
+            self.beginPhase('save')
+            self.torGroup.SAVE_DATA()
+            saved = self.waitPhase('save',self.torNodes(),timeout=conf.getProp('save_timeout',900))
+            self.log.debug("[%s] Data Saved" % self.tag)
+            missing = [n for n in self.torNodes() if n not in saved]
+            if missing:
+                self.index.record(self.identity,self.tag,ResultIndex.FAILED,missing=missing)
+                self.store.finish_run(self.run_id,state.FAILED)
+            else:
+                self.index.record(self.identity,self.tag,ResultIndex.COMPLETE,
+                                  results=conf.resultsPath(),finished=time.time())
+                self.store.finish_run(self.run_id,state.COMPLETE)
+        except RunCancelled:
+            self.log.info("[%s] Cancelled during '%s', stopping" % (self.tag, self.phase))
+            self.store.finish_run(self.run_id,state.ABORTED)
+            try:
+                self.stop()
+            except Exception as e:
+                self.log.debug("[%s] Error stopping: %s" % (self.tag, e))
+        except Exception as e:
+            self.log.debug("[%s] Error: %s" % (self.tag, e))
+            self.index.record(self.identity,self.tag,ResultIndex.FAILED,error=str(e))
+            self.store.finish_run(self.run_id,state.FAILED)
+        self.phase = None
+
+    def cancel(self):
+        """Ask the run to stop at the next phase boundary (or right away if it
+        is waiting)"""
+        self.cancelled.set()
+
+    def checkCancelled(self):
+        if self.cancelled.isSet():
+            raise RunCancelled()
+
+    def beginPhase(self,phase):
+        """Record the start of phase and forget any earlier reports for it"""
+        self.checkCancelled()
+        self.phase = phase
+        self.phase_started = time.time()
+        self.collector.clear(phase,self.tag)
+        self.store.start_phase(self.run_id,phase)
+
+    def waitPhase(self,kind,nodes,fraction=1.0,timeout=900):
+        """Wait until fraction of nodes have reported kind to the collector.
+        Returns the nodes that did"""
+        started = time.time()
+        count = int(math.ceil(fraction * len(nodes)))
+        while True:
+            # Wait in short slices so a cancel doesn't have to sit out the timeout
+            remaining = started + timeout - time.time()
+            acked = self.collector.wait(kind,nodes,tag=self.tag,timeout=max(min(remaining,1),0),count=count)
+            if len([n for n in nodes if n in acked]) >= count or remaining <= 0:
+                break
+            self.checkCancelled()
+        for node in acked:
+            self.store.ack(self.run_id,kind,node,acked[node])
+        missing = [n for n in nodes if n not in acked]
+        if len(nodes) - len(missing) < count:
+            self.log.warning("[%s] Timed out after %d seconds waiting for '%s' from %s" % (self.tag, timeout, kind, ",".join(missing)))
+            self.store.finish_phase(self.run_id,kind,state.FAILED)
+        else:
+            self.log.info("[%s] %d/%d nodes reported '%s' after %.1f seconds" % (self.tag, len(nodes) - len(missing), len(nodes), kind, time.time() - started))
+            self.store.finish_phase(self.run_id,kind)
+        return acked
+
+    def stop(self,cleanup=False):
+        self.webGroup.STOP()
+        self.torGroup.STOP()
+        if self.tcpGroup:
+            self.tcpGroup.STOP()
+        self.torGroup.KILL()
+        if cleanup is True:
+            self.torGroup.RM_CACHE()
+        self.log.debug("[%s] Sent STOP command to web and Tor groups" % self.tag)
+
 #class ExperimentRunner(messaging,cmd.Cmd):
 class ExperimentRunner(cmd.Cmd):
     """ A command line tool for running SAFEST-Tor experiments on DETER """
@@ -68,6 +495,8 @@ class ExperimentRunner(cmd.Cmd):
     def do_quit(self,arg):
         """quit the program"""
         self.do_stop_current_experiment(None)
+        if self.worker is not None:
+            self.worker.join()
         sys.exit(0)
 
     def do_add(self,arg):
@@ -93,8 +522,10 @@ class ExperimentRunner(cmd.Cmd):
             return
 
         try:
-            self.experiments[name] = ExperimentConfig(exp_filename)
-            self.experiments[name].name = name
+            expConf = ExperimentConfig(exp_filename)
+            expConf.name = name
+            self.addExperiment(expConf)
+            self.state.save_experiment(name,expConf.conf)
         except yaml.YAMLError, exc:
             if hasattr(exc, 'problem_mark'):
                 mark = exc.problem_mark
@@ -108,6 +539,26 @@ class ExperimentRunner(cmd.Cmd):
 
         print "Experiment '%s' added successfully" % name
 
+    def addExperiment(self,expConf):
+        """Register expConf, expanding it if it describes a sweep"""
+        if expConf.getProp('sweep',None) or expConf.getProp('replicates',1) > 1:
+            runs = expConf.expand()
+            for run in runs:
+                self.experiments[run.name] = run
+            self.sweeps[expConf.name] = [run.name for run in runs]
+            print "Expanded '%s' into %d runs" % (expConf.name, len(runs))
+        self.experiments[expConf.name] = expConf
+
+    def loadExperiments(self,store):
+        """Add the experiments saved in store, returning their names"""
+        names = []
+        for (name,conf) in store.experiments():
+            expConf = ExperimentConfig(conf=conf)
+            expConf.name = name
+            self.addExperiment(expConf)
+            names.append(name)
+        return names
+
     def do_list(self,arg=None):
         """list [exp] 
         - Print a list of the known experiments or the configuration for 'exp'"""
@@ -123,18 +574,31 @@ class ExperimentRunner(cmd.Cmd):
             if arg in self.experiments: 
                 print bold("'%s' Configuration" % arg)
                 print self.experiments[arg]
+                if arg in self.sweeps:
+                    print bold("Runs:")
+                    print "\n".join(self.sweeps[arg])
             else:
                 print "No experiment called '%s' exists" % arg
 
     def do_stop_current_experiment(self,exp):
-        """ Stop a running experiment immediately. Do \033[1mNOT\033[0;0m save data"""
+        """stop_current_experiment [name]
+        Stop the running experiment <name>, or everything that is running and
+        queued. Do \033[1mNOT\033[0;0m save data"""
 
         if self.status is ExperimentRunner.STATUS_WAIT:
             print "No experiment currently running"
             return
+
+        if exp:
+            if exp not in self.runs:
+                print "'%s' is not running" % exp
+                return
+            self.runs[exp].cancel()
         else:
-            from backend.scriptbase import run
-            run(self.stopExpImpl)
+            self.stopping.set()
+            for expRun in self.runs.values():
+                expRun.cancel()
+        print "Stopping. Check 'status' for progress"
             
     def do_run(self,exp):
         """run <experiment_name> [<experiment_name ...]
@@ -142,108 +606,215 @@ class ExperimentRunner(cmd.Cmd):
         or the list of experiments if applicable."""
 
         if self.status is ExperimentRunner.STATUS_RUN:
-            print "Already running experiment '%s'" % self.running_exp
+            print "Already running experiments, see 'status'"
             return
 
         if not exp:
             print "Requires an experiment name to run"
             return
 
-            
-        for experiment_name in exp.split(' '):
 
-            from backend.scriptbase import ScriptController
+        confs = []
+        for experiment_name in exp.split(' '):
             try:
-                expConf = self.experiments[experiment_name]
+                if experiment_name in self.sweeps:
+                    matrix = [self.experiments[n] for n in self.sweeps[experiment_name]]
+                else:
+                    matrix = [self.experiments[experiment_name]]
             except KeyError:
-                print "No such experiment"
-            else:
-                try:
-                    self.to_run = expConf;
-
-                    ## NOTE
-                    #  This is one of the kludgier things I have ever done.
-                    #  All of the rest of this function was copied from backend/scriptbase.py
-                    #  because the run function that gets imported otherwise calls sys.exit(0)
-                    #  when it completes. This (obviously) precludes us from running a series
-                    #  of experiments. 
-                    #
-                    #  Not exactly Object Orientation the way it was intended, but it works.
-                    #
-                    basename = os.path.basename(sys.argv[0][:-3])
-                    signal.signal(signal.SIGINT, signal.SIG_DFL)
-                    logSetup(basename, False)
-
-                    # Use script name as node name and then start everything
-                    messaging = ScriptController(basename, testbed.cafile, testbed.nodefile, self.runExpImpl)
-                    messaging.loop()
-                    # Messaging loop exists when stop is called or running = False
-                    if messaging.started:
-                        messaging.script.join()
-                    self.log.info("Waiting 15 minutes before starting the next experiment to allow out of band things to finish (e.g. copying data).")
-                    time.sleep(900)
-                except Exception as e:
-                    print "Unknown Error: %s" % e
+                print "No such experiment '%s'" % experiment_name
+                continue
+            for conf in matrix:
+                entry = self.resultIndex(conf).get(conf.identity())
+                if entry is not None and entry['status'] == ResultIndex.COMPLETE:
+                    print "Skipping '%s', already complete as '%s' in %s" % (conf.name, entry['name'], entry.get('results'))
+                else:
+                    confs.append(conf)
 
-    def do_status(self,arg):
-        """Show the status of this ExperimentRunner instance"""
-        if self.status == ExperimentRunner.STATUS_RUN:
-            print "Currently running '%s" % self.running_exp
-        else:
-            print "No activity"
+        if not confs:
+            print "Nothing to run"
+            return
 
-    def runExpImpl(self,messaging):
-        """Run the experiment currently configured to run"""
-        
         try:
-            self.torGroup = messaging.newGroup('TOR','Tor_%s' % self.to_run.name)
-            self.log.info("Tor Group established")
-            self.webGroup = messaging.newGroup('Socks HTTP',"Web_%s" % self.to_run.name)
-            self.log.info("Web Group established")
-            if self.to_run.getProp('use_tcp_app') is not None:
-                self.tcpGroup = messaging.newGroup("Socks Application", "Web_%s" % self.to_run.name)
-            else:
-                self.tcpGroup = None
-            self.setupExp(self.to_run)
-            self.log.info("Experiment set up.")
+            waves = allocatePools(confs,self.inventory)
         except Exception as e:
-            self.log.debug("Encountered unknown error: %s" % e)
+            print "Error: %s" % e
+            return
 
+        self.status = ExperimentRunner.STATUS_RUN
+        self.stopping.clear()
+        self.worker = threading.Thread(target=self.runWaves,args=(waves,))
+        self.worker.setDaemon(True)
+        self.worker.start()
+        print "Started %d runs, see 'status'" % sum([len(wave) for wave in waves])
+
+    def runWaves(self,waves):
+        """Run each wave in turn. Runs in the background so the prompt stays
+        usable"""
+        for wave in waves:
+            if self.stopping.isSet():
+                self.log.info("Stopped, skipping %s" % ", ".join([conf.name for (conf,offsets) in wave]))
+                continue
+            try:
+                self.to_run = [ExperimentRun(self,conf,offsets,len(wave)) for (conf,offsets) in wave]
+                self.running_exp = [conf.name for (conf,offsets) in wave]
+                self.script_lock.acquire()
+                try:
+                    self.runScript(self.runBatchImpl)
+                finally:
+                    self.script_lock.release()
+            except Exception as e:
+                self.log.debug("Unknown Error: %s" % e)
+        self.running_exp = None
+        self.status = ExperimentRunner.STATUS_WAIT
+
+    def do_nodes(self,arg):
+        """nodes <num_dirs> <num_relays> <num_clients> <num_servers>
+        Tell the runner how many nodes of each kind the testbed has, so
+        experiments in one 'run' can share them in parallel. Without this
+        experiments run one after the other."""
         try:
-            self.status = ExperimentRunner.STATUS_RUN
-            self.running_exp = self.to_run
+            counts = [int(n) for n in arg.split(None)]
+            if len(counts) != len(NODE_KINDS):
+                raise ValueError
+        except ValueError:
+            print "Missing arguments. %s" % self.do_nodes.__doc__
+            return
+        self.inventory = dict(zip(NODE_KINDS,counts))
+        print "Node inventory: %s" % ", ".join(["%d %s" % (self.inventory[k],k) for k in NODE_KINDS])
+
+    def runScript(self,func):
+        """Run func(messaging) inside a SEER script controller and wait for it"""
+        from backend.scriptbase import ScriptController
+
+        ## NOTE
+        #  This is one of the kludgier things I have ever done.
+        #  All of the rest of this function was copied from backend/scriptbase.py
+        #  because the run function that gets imported otherwise calls sys.exit(0)
+        #  when it completes. This (obviously) precludes us from running a series
+        #  of experiments. 
+        #
+        #  Not exactly Object Orientation the way it was intended, but it works.
+        #
+        basename = os.path.basename(sys.argv[0][:-3])
+        if threading.currentThread().getName() == 'MainThread':
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+        logSetup(basename, False)
+
+        # Use script name as node name and then start everything
+        messaging = ScriptController(basename, testbed.cafile, testbed.nodefile, func)
+        messaging.loop()
+        # Messaging loop exists when stop is called or running = False
+        if messaging.started:
+            messaging.script.join()
+
+    def do_query(self,arg):
+        """query <experiment_name> <node[,node...]|all> <command>[;<command>...]
+        Send control port commands to Tor nodes of a configured experiment and
+        print every node's response in one table"""
 
-            self.log.debug("Sending RM_CACHE")
-            self.stopExpImpl(cleanup=True)
-            self.log.debug("Sending START to Tor")
-            self.torGroup.START()
-            time.sleep(900)
-            self.log.debug("Sending START to Web")
-            self.webGroup.START()
-            if self.tcpGroup:
-                self.tcpGroup.START()
-            self.log.debug("Letting it run for 9000 seconds")
-            time.sleep(9000)
-            self.log.debug("Stopping everything")
-            self.stopExpImpl()
-            self.log.debug("Stopped. Saving Data")
-            self.torGroup.SAVE_DATA()
-            self.log.debug("Data Saved")
-            self.running_exp = None
-            self.status = ExperimentRunner.STATUS_WAIT
+        try:
+            (name,nodes,msg) = arg.split(None,2)
+            expConf = self.experiments[name]
+        except ValueError:
+            print "Missing arguments. %s" % self.do_query.__doc__
+            return
+        except KeyError:
+            print "No experiment called '%s' exists" % name
+            return
+
+        expRun = self.runs.get(name) or ExperimentRun(self,expConf)
+        if nodes == 'all':
+            nodes = expRun.torNodes()
+        else:
+            nodes = nodes.split(',')
+
+        self.query = (expRun,nodes,msg)
+        self.collector.clear('ctl',msg)
+        try:
+            # Only one script controller may consume messaging at a time, so
+            # while experiments run the query goes out on theirs
+            while True:
+                messaging = self.messaging
+                if messaging is not None:
+                    self.queryImpl(messaging)
+                    break
+                if self.script_lock.acquire(False):
+                    try:
+                        self.runScript(self.queryImpl)
+                    finally:
+                        self.script_lock.release()
+                    break
+                time.sleep(0.1)
         except Exception as e:
-            self.log.debug("Error: %s" % e)
+            print "Unknown Error: %s" % e
+            return
 
+        results = self.collector.get('ctl',msg)
+        print bold("%-15s %-7s %s" % ("Node","Status","Response"))
+        for node in nodes:
+            if node not in results:
+                print "%-15s %-7s %s" % (node,"-","(no response)")
+                continue
+            for reply in results[node]:
+                lines = reply['lines'] or [""]
+                print "%-15s %-7s %s" % (node,reply['status'],lines[0])
+                for line in lines[1:]:
+                    print "%-15s %-7s %s" % ("","",line)
+
+    def queryImpl(self,messaging):
+        """Send the pending query out and wait for the responses"""
+        (expRun,nodes,msg) = self.query
+        group = messaging.newGroup('TOR','Tor_%s' % expRun.tag)
+        group.ctl_dst = ",".join(nodes)
+        group.ctl_msg = msg
+        group.collector = self.collectorAddress()
+        group.QUERY_CTRL()
+        self.collector.wait('ctl',nodes,tag=msg,timeout=60)
 
-    def stopExpImpl(self,cleanup=False):
-        self.webGroup.STOP()
-        self.torGroup.STOP()
-        if self.tcpGroup:
-            self.tcpGroup.STOP()
-        self.torGroup.KILL()
-        if cleanup is True:
-            self.torGroup.RM_CACHE()
-        self.log.debug( "Sent STOP command to web and Tor groups")
+    def do_status(self,arg):
+        """Show the status of this ExperimentRunner instance"""
+        if self.status == ExperimentRunner.STATUS_RUN:
+            running = self.running_exp
+            if running is None:
+                print "Starting up"
+            else:
+                print "Currently running %s" % ", ".join(["'%s'" % name for name in running])
+            for expRun in self.runs.values():
+                if expRun.phase is not None:
+                    phase = "'%s' for %ds" % (expRun.phase, time.time() - expRun.phase_started)
+                else:
+                    phase = "starting"
+                if expRun.cancelled.isSet():
+                    phase += ", stopping"
+                print "  %s: %s on %s" % (expRun.tag, phase, ",".join(expRun.torNodes()))
+        else:
+            print "No activity"
+
+    def runBatchImpl(self,messaging):
+        """Run the current wave of experiments side by side"""
+        self.messaging = messaging
+        threads = []
+        for expRun in self.to_run:
+            try:
+                expRun.setup(messaging)
+            except Exception as e:
+                self.log.debug("Encountered unknown error setting up '%s': %s" % (expRun.tag, e))
+                continue
+            self.runs[expRun.tag] = expRun
+            t = threading.Thread(target=expRun.run)
+            t.start()
+            threads.append(t)
+
+        for t in threads:
+            t.join()
+        self.runs = dict()
+        self.messaging = None
+
+    def teardownImpl(self,messaging):
+        for expRun in self.to_run:
+            expRun.setup(messaging)
+            expRun.stop(cleanup=True)
 
     def complete_load(self, text, line, begidx, endidx):
 
@@ -266,47 +837,18 @@ class ExperimentRunner(cmd.Cmd):
 
         return completions
 
-    def setupExp(self,expConf):
-        """Prepare to run the experiment expConf"""
-        try:
-            dirs = [ "directory%i" % i for i in xrange(1,expConf.getProp('num_dirs')+1)]  
-            relays = ["router%i" % i for i in xrange(1,expConf.getProp('num_relays')+1)]    
-            clients = ["client%i" % i for i in xrange(1,expConf.getProp('num_clients')+1)] 
-            servers = ["server%i" % i for i in xrange(1,expConf.getProp('num_servers')+1)] 
-
-            self.torGroup.directory = ",".join(dirs)
-            self.torGroup.relays = ",".join(relays)
-            self.torGroup.clients = ",".join(clients)
-
-            self.torGroup.template_dir = expConf.getProp('template_dir')
-            self.torGroup.tor_binary = expConf.getProp('tor_binary')
-            self.torGroup.save_data_dir = expConf.getProp('save_data_location')
-            self.torGroup.client_config_list = ",".join(expConf.getProp('client_config_options'))
-            self.torGroup.relay_config_list = ",".join(expConf.getProp('relay_config_options'))
-
-            self.webGroup.clients = ",".join(clients)
-            self.webGroup.servers = ",".join(servers)
-            self.webGroup.socks_addr = expConf.getProp('socks_address')
-            self.webGroup.logpath = '/var/lib/tor/'
-            self.webGroup.think = expConf.getProp('thinking_time')
-            self.webGroup.sizes = expConf.getProp('file_sizes')
-
-            if self.tcpGroup is not None:
-                self.tcpGroup.clients = ",".join(clients)
-                self.tcpGroup.servers = ",".join(servers)
-                self.tcpGroup.socks_addr = expConf.getProp('socks_address')
-                self.tcpGroup.logpath = '/var/lib/tor/'
-                self.tcpGroup.think = expConf.getProp('use_tcp_app:thinking_time') 
-                self.tcpGroup.server_cmd = expConf.getProp("use_tcp_app:server_cmd")
-                self.tcpGroup.app_cmd = expConf.getProp("use_tcp_app:client_cmd")
-
+    def resultIndex(self,conf):
+        location = conf.getProp('save_data_location')
+        if location not in self.indexes:
+            self.indexes[location] = ResultIndex(location)
+        return self.indexes[location]
 
-        except Exception as e:
-            print "Error: %s" % e
+    def collectorAddress(self):
+        return "%s:%s" % (testbed.nodename, self.collector.server_address[1])
 
     def do_save(self,arg):
         """save <path>
-        save the current configuration from <path>"""
+        save the configured experiments to the state database <path>"""
                   
         if not arg:
             print "Need a pathname to save to"
@@ -314,15 +856,19 @@ class ExperimentRunner(cmd.Cmd):
 
         args = arg.split(None)
         if os.path.exists(args[0]):
-            print "%s already exists. Will not overwrite"
+            print "%s already exists. Will not overwrite" % args[0]
             return 
 
-        curr = self.running_exp if hasattr(self,'running_exp') else None
-        pickle.dump((self.experiments,self.status,curr),open(args[0],'wb'),-1)
+        store = state.StateStore(args[0])
+        try:
+            for (name,conf) in self.state.experiments():
+                store.save_experiment(name,conf)
+        finally:
+            store.close()
 
     def do_load(self,arg):
         """load <path> 
-        Load a saved configuration from <path>"""
+        Load the experiments saved in the state database <path>"""
 
         if not arg:
             print "need a path to load from"
@@ -334,17 +880,76 @@ class ExperimentRunner(cmd.Cmd):
             return
 
         try:
-            (self.experiments,self.status,self.running_exp) = pickle.load(open(args[0], 'rb'))
+            store = state.StateStore(args[0])
+            try:
+                for name in self.loadExperiments(store):
+                    self.state.save_experiment(name,self.experiments[name].conf)
+            finally:
+                store.close()
         except Exception as e:
             print "Error Loading file: %s" % e 
             return
 
+    def do_history(self,arg):
+        """history [name]
+        Show how long each phase took across finished runs (optionally only
+        runs whose name starts with <name>)"""
+        rows = self.state.history(arg.strip() or None)
+        if not rows:
+            print "No finished phases recorded"
+            return
+        print bold("%-10s %5s %10s %10s %10s" % ("Phase","Runs","Mean","Min","Max"))
+        for (phase,n,mean,shortest,longest) in rows:
+            print "%-10s %5d %10.1f %10.1f %10.1f" % (phase,n,mean,shortest,longest)
+
+    def do_recover(self,arg):
+        """recover [teardown|rerun]
+        List runs a previous runner left unfinished. 'teardown' stops Tor and
+        cleans up on their nodes, 'rerun' also runs them again"""
+        if self.status is ExperimentRunner.STATUS_RUN:
+            print "Can't recover while experiments are running"
+            return
+        unfinished = self.state.unfinished()
+        if not unfinished:
+            print "No unfinished runs"
+            return
+
+        for run in unfinished:
+            print "%-30s started %s, last phase '%s'" % (run['name'], time.ctime(run['started']), self.state.current_phase(run['id']))
+        action = arg.strip()
+        if action not in ('teardown','rerun'):
+            return
+
+        names = []
+        self.to_run = []
+        for run in unfinished:
+            if run['name'] in self.experiments:
+                self.to_run.append(ExperimentRun(self,self.experiments[run['name']],run['offsets']))
+                names.append(run['name'])
+            else:
+                print "'%s' is no longer configured, only marking it aborted" % run['name']
+            self.state.finish_run(run['id'],state.ABORTED)
+        for expRun in self.to_run:
+            expRun.pools = len(self.to_run)
+
+        try:
+            self.runScript(self.teardownImpl)
+        except Exception as e:
+            print "Unknown Error: %s" % e
+            return
+        self.to_run = []
+
+        if action == 'rerun' and names:
+            self.do_run(" ".join(names))
+
     def __handle_term(self):
         self.do_quit(list())
 
     def __init__(self):
         cmd.Cmd.__init__(self)
         self.experiments = dict()
+        self.sweeps = dict()
+        self.indexes = dict()
         self.log = logging.getLogger("ExperimentRunner")
         self.log.setLevel(logging.DEBUG)
         fmt = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s') 
@@ -355,6 +960,19 @@ class ExperimentRunner(cmd.Cmd):
         self.log.addHandler(fh)
         self.log.addHandler(sh)
         self.status =  ExperimentRunner.STATUS_WAIT
+        self.running_exp = None
+        self.runs = dict()
+        self.inventory = None
+        self.worker = None
+        self.messaging = None
+        self.script_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.collector = collector.Collector()
+        self.collector.start()
+        self.state = state.StateStore('ExperimentRunner.db')
+        self.loadExperiments(self.state)
+        if self.state.unfinished():
+            print "Found runs left unfinished by an earlier runner, see 'recover'"
 
 
 signal.signal(signal.SIGTERM,signal.SIG_IGN)
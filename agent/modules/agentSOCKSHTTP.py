@@ -9,18 +9,31 @@
 #
 
 from util.platform import spawn
-from util.cidr import CIDR
 from subprocess import Popen,call,check_call
-from backend.agent import Agent, AddressPool
+from backend.agent import Agent
 from backend.variables import *
 from backend.addon import services
+from testbed import testbed
 import logging
+from string import Template
 import signal
-import apt
+import socket
 import sys
 import os
 import time
 
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from safest import provision
+from safest import bundle
+from safest import collector
+from safest import trace
+from safest import desttable
+from safest import sizeserver
+from safest import socksfetch
+from safest import workload
+
+provision.require('curl')
+
 def writeout(f,msg):
         f.write("%s\n" % msg)
         f.flush()
@@ -36,7 +49,7 @@ class SocksHTTPAgent(Agent):
     AGENTGROUP = 'Traffic'
     AGENTTYPE = 'Socks HTTP'
     NICENAME = 'Proxied Web'
-    COMMANDS = ['START','STOP']
+    COMMANDS = ['START','STOP','APPLY']
     VARIABLES = [
         Title('Web Settings'),
         NodeListVar('clients', None, 'Clients', 'Select the nodes that will become HTTP agents'),
@@ -44,57 +57,84 @@ class SocksHTTPAgent(Agent):
         StringVar('socks_addr','localhost:9050','Socks Proxy Address', 'The address and port of the SOCKS proxy to use'),
         DistVar('think', 1, 'Thinking Time', 'Function to determine time between requests'),
         DistVar('sizes', 1, 'File Sizes', 'Function to determine the size of the page requested'),
-        StringVar('logpath',None,'Log Path', "The directory to log output to")
+        StringVar('logpath',None,'Log Path', "The directory to log output to"),
+        StringVar('server_mode','apache','Server Mode', "'apache' serves getsize.py from Apache, 'builtin' from the agent's own event driven server"),
+        StringVar('fetcher','native','Fetcher', "'native' fetches in process through the SOCKS proxy, 'curl' runs curl for every request"),
+        IntVar('users',1,'Users', "Number of independent virtual users this client node simulates (native fetcher only)"),
+        IntVar('max_concurrent',0,'Max Concurrent', "Most fetches a client node keeps in flight at once across its users (0 for one per user)"),
+        StringVar('mode','closed','Mode', "'closed': each user waits for its fetch, then thinks. 'open': fetches start as a Poisson process of arrival_rate regardless of completions (native fetcher only)"),
+        StringVar('arrival_rate','1','Arrival Rate', "Mean fetches started per second on each client node in open mode"),
+        IntVar('max_outstanding',100,'Max Outstanding', "Open mode drops (and counts) arrivals while this many fetches are in flight"),
+        StringVar('seed',None,'Seed', "Workload schedules are derived from this and the node name (default the experiment name)"),
+        IntVar('duration',86400,'Duration', "Seconds of requests to schedule"),
+        StringVar('trace',None,'Trace',"A trace of '<offset> <destination> <size>' lines to replay instead of drawing from think/sizes; ${NODE} is replaced by the node name"),
+        StringVar('collector',None,'Collector','host:port of the ExperimentRunner collector to acknowledge bundles to'),
+        StringVar('bundle',None,'Variable Bundle','JSON bundle of variable values, applied in one step before START (see safest/bundle.py)')
         ]
 
-    def install_packages(self, names):
-        """Use python-apt to install a list of packages, such as tor"""
-        # THIS ONLY WORKS ON UBUNTU
-        
-        self.log.info("Install packages")
-        
-        cache = apt.Cache()
-        
-        self.log.info("Updating apt cache")
-
-        try:
-            cache.update()
-        except Exception as e:
-            self.log.info("Failed to update the apt cache: %s" % str(e))
-            self.log.info("Are you running as root?")
+    # Seconds to keep trying to bind port 80 after stopping Apache
+    BIND_TIMEOUT = 10
 
-        cache.open(None)
+    def __init__(self):
+        Agent.__init__(self)
+        self.dests = None
+        self.sizeserver = None
 
-        self.log.info("Marking packages")
-
-        for name in names:
+    handleSTOP = Agent.TGStop
+    def serverExec(self):
+        if self.server_mode != 'builtin':
+            services.ApacheService.start()
+            return
+        if self.sizeserver is not None and self.sizeserver.isAlive():
+            return
+        # Same port and URLs as Apache, so clients don't need to know
+        services.ApacheService.stop()
+        logfile = None
+        if self.logpath:
+            logfile = "%s/%s.serve.log" % (self.logpath, testbed.getNodeName())
+        deadline = time.time() + self.BIND_TIMEOUT
+        while True:
             try:
-                pkg = cache[name]
-                
-                if not pkg.is_installed:
-                    self.log.info("Marking %s for installation" % name)
-                    pkg.mark_install()
+                self.sizeserver = sizeserver.SizeServer(80, self.log, logfile)
+                break
+            except socket.error as e:
+                # Apache may not have let go of the port yet
+                if time.time() > deadline:
+                    self.log.error("Unable to serve on port 80 (%s), falling back to Apache" % e)
+                    self.sizeserver = None
+                    services.ApacheService.start()
+                    return
+                time.sleep(0.5)
+        self.sizeserver.start()
+        self.log.info("Serving getsize.py from the built-in server, logging to %s" % logfile)
 
-            except Exception as e:
-                self.log.info("Problem looking up or marking %s for installation: %s" % (name, str(e)))
-
-        self.log.info("Installing packages...")
+    def serverStop(self):
+        if self.sizeserver is not None:
+            self.sizeserver.stop()
+            self.sizeserver = None
+            return
+        services.ApacheService.stop()
 
+    def apply_bundle(self):
+        """Apply a newer variable bundle, if one was sent, and acknowledge it"""
         try:
-            cache.commit()
-        except Exception as e:
-            self.log.info("Failed to install packages: %s" % str(e))
-            self.log.info("Are you running as root?")
-                       
-
-    def __init__(self): Agent.__init__(self)
+            applied = bundle.apply(self, testbed.nodename)
+        except bundle.BundleError as e:
+            self.log.error(str(e))
+            return
+        if applied is not None and self.collector:
+            (version, tag) = applied
+            try:
+                collector.report(self.collector, 'bundle', testbed.nodename, {'version': version}, tag=tag)
+            except collector.CollectorError as e:
+                self.log.warning(str(e))
 
-    handleSTOP = Agent.TGStop
-    def serverExec(self): services.ApacheService.start()
-    def serverStop(self): services.ApacheService.stop()
+    def handleAPPLY(self):
+        self.apply_bundle()
 
     def handleSTART(self):
-        self.install_packages(['curl'])
+        self.apply_bundle()
+        provision.ensure(self.log, testbed.experiment)
         
         if self.logpath:
             try:
@@ -113,15 +153,15 @@ class SocksHTTPAgent(Agent):
     def clientExec(self, src, dst, size):
         self.log.info("Starting")
 
-        ip_regex = re.compile('\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}')
-        if ip_regex.match(dst) is None:
-            dst2 = testbed.getIPForNode(dst)
-            #dst2 = "%s.%s.%s" % (dst, testbed.getExperiment(), testbed.getProject())
-            dst = dst2[0]
+        (dst, prefix) = self.dests.lookup(dst)
 
         self.log.info("Chose to download from %s" % dst)
 
-        url = "http://%s/getsize.py?length=%d " % (dst, size)
+        if self.fetcher != 'curl':
+            self.nativeExec(dst, size)
+            return
+
+        url = "%s%d" % (prefix, size)
         logstring = "%s %%{time_connect} TTFB: %%{time_starttransfer} Total time: %%{time_total} Size: %%{size_download}\\n" % int(time.time())
         cmd = ['/usr/bin/curl', '--socks4', self.socks_addr, '-o','/dev/null','-w',logstring,url] 
         # We print this on stdout so it goes with redirected stdout
@@ -135,6 +175,103 @@ class SocksHTTPAgent(Agent):
         self.log.info("Curl finished with code %s" %ret)
         #subpid = spawn(cmd, self.log.info)
    
+    def clientInit(self):
+        Agent.clientInit(self)
+        self.proxy = socksfetch.parse_proxy(self.socks_addr)
+        self.dests = desttable.DestinationTable(self.servers or (), testbed.getIPForNode,
+                                                lambda ip: "http://%s/getsize.py?length=" % ip,
+                                                self.traceDestinations())
+
+    def makeFetch(self, dst, size):
+        return socksfetch.Fetch(self.proxy, dst, 80, "/getsize.py?length=%d" % int(size))
+
+    def nativeExec(self, dst, size):
+        """Fetch size bytes from dst through the SOCKS proxy without forking"""
+        fetch = self.makeFetch(dst, size)
+        loop = socksfetch.FetchLoop()
+        loop.add(fetch)
+        loop.run()
+        self.logFetch(fetch)
+
+    def tracePath(self):
+        return Template(self.trace).safe_substitute(NODE=testbed.nodename)
+
+    def traceDestinations(self):
+        """The destinations our trace uses, so they go in the table up front"""
+        if not self.trace:
+            return ()
+        return trace.destinations(self.tracePath())
+
+    def destinationIPs(self):
+        return list(self.dests.hosts)
+
+    def makeSchedule(self, user=0, rate=None):
+        """Precompute a user's requests from a seed derived from the experiment
+           and save them with our logs"""
+        hosts = self.destinationIPs()
+        seed = workload.node_seed(self.seed or testbed.experiment, testbed.nodename, user)
+        if rate is None:
+            schedule = workload.closed_schedule(seed, self.think, self.sizes, hosts, self.duration)
+        else:
+            schedule = workload.open_schedule(seed, rate, self.sizes, hosts, self.duration)
+        path = "%s/%s.%d.schedule" % (self.logpath or '/tmp', testbed.getNodeName(), user)
+        schedule.save(path)
+        self.log.info("Scheduled %d requests for user %d with seed %d, saved to %s" % (len(schedule), user, seed, path))
+        if schedule.truncated:
+            self.log.warning("User %d's schedule was cut off at %d requests, it will end before %d seconds"
+                             % (user, len(schedule), self.duration))
+        return schedule
+
+    def scheduleLoop(self):
+        """Make the scheduled requests one after another"""
+        schedule = self.makeSchedule()
+        for i in xrange(len(schedule)):
+            (gap, size, host) = schedule.entry(i)
+            time.sleep(gap)
+            self.clientExec(None, host, size)
+
+    def usersLoop(self):
+        """Simulate self.users users from this one process, each with its own
+           think time and size draws"""
+        self.log.info("Simulating %d users" % self.users)
+        schedules = [self.makeSchedule(user) for user in xrange(self.users)]
+        users = workload.ClosedLoop(socksfetch.FetchLoop(), schedules, self.makeFetch,
+                                    self.max_concurrent, self.logFetch)
+        users.run()
+
+    def openLoop(self):
+        """Offer a fixed load: start fetches at arrival_rate per second no
+           matter how quickly they complete"""
+        self.log.info("Open loop at %s fetches/s" % self.arrival_rate)
+        schedule = self.makeSchedule(rate=float(self.arrival_rate))
+        arrivals = workload.OpenLoop(socksfetch.FetchLoop(), schedule, self.makeFetch,
+                                     self.max_outstanding, self.logFetch, self.logDropped, self.log)
+        arrivals.run()
+
+    def replayLoop(self):
+        """Issue the fetches in our trace at their recorded times"""
+        path = self.tracePath()
+        loop = socksfetch.FetchLoop()
+        self.log.info("Replaying %s" % path)
+
+        def issue(record):
+            (offset, dst, size) = record
+            fetch = self.makeFetch(self.dests.lookup(dst)[0], int(size))
+            fetch.callback = self.logFetch
+            loop.add(fetch)
+
+        trace.Replayer(path, issue, loop.poll, self.log).run()
+        loop.run()
+
+    def logDropped(self, when, outstanding):
+        sys.stdout.write("%d DROPPED Outstanding: %d\n" % (int(when), outstanding))
+
+    def logFetch(self, fetch):
+        # Same line curl -w wrote, on stdout so it goes with redirected stdout
+        sys.stdout.write("%s\n" % fetch.line())
+        if fetch.error is not None:
+            self.log.info("Fetch from %s failed: %s" % (fetch.host, fetch.error))
+
     def TGStart(self): 
         if len(self.pids) > 0:
             self.log.info("Already running, not restarting")
@@ -184,15 +321,6 @@ class SocksHTTPAgent(Agent):
             writeout(fperr,"Forked child process as %s" % pid)
             signal.signal(signal.SIGCHLD, signal.SIG_IGN)
     
-            spool = AddressPool(testbed.nodename, services.RoutingService.getFake(testbed.nodename))
-            dpool = AddressPool()
-            if self.servers:
-                for s in self.servers:
-                    dst = testbed.getIPForNode(s)
-                    self.log.info("Adding '%s' to the destination pool" % dst)
-                    dpool.Set(s, [CIDR(inputstr=ip) for ip in dst])
-
-            
             if not self.logfilename:
                 logfile = "/local/logs/%s.%s" % (self.AGENTTYPE, self.group)
             else:
@@ -215,16 +343,15 @@ class SocksHTTPAgent(Agent):
         
             # Loop based on wait times
             try:
-                while (True):
-                    """
-                    if 'autoquit' in self.VARIABLES:
-                        elapsed = time.time() - starttime;
-                        if ((self.autoquit > 0) and (elapsed > self.autoquit)):
-                            os.killpg(0, signal.SIGTERM) # This should kill me and my children as I forked/setsid()
-                            return
-                    """
-        
-                    self.clientOneLoop(spool, dpool, self.think, self.sizes)
+                if self.trace:
+                    self.replayLoop()
+                    return
+                if self.mode == 'open' and self.fetcher != 'curl':
+                    self.openLoop()
+                elif self.users > 1 and self.fetcher != 'curl':
+                    self.usersLoop()
+                else:
+                    self.scheduleLoop()
     
             except Exception,e:
                 writeout(fperr,"error in client process: %s"% e);
@@ -4,19 +4,27 @@
 # Based on SocksHTTPAgent by SPARTA, Inc.
 #
 from util.platform import spawn
-from util.cidr import CIDR
 from subprocess import Popen,call,check_call
-from backend.agent import Agent, AddressPool
+from backend.agent import Agent
 from backend.variables import *
-from backend.addon import services
+from testbed import testbed
 import logging
 from string import Template
 import signal
-import apt
 import sys
 import os
 import time
 
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from safest import provision
+from safest import bundle
+from safest import collector
+from safest import trace
+from safest import desttable
+from safest import workload
+
+provision.require('dante-client')
+
 def writeout(f,msg):
         f.write("%s\n" % msg)
         f.flush()
@@ -41,7 +49,7 @@ class SocksAppAgent(Agent):
     AGENTGROUP = 'Traffic'
     AGENTTYPE = 'Socks Application'
     NICENAME = 'Proxied TCP App'
-    COMMANDS = ['START','STOP']
+    COMMANDS = ['START','STOP','APPLY']
     VARIABLES = [
         Title('Settings'),
         NodeListVar('clients', None, 'Clients', 'Select the nodes that will become HTTP agents'),
@@ -51,50 +59,17 @@ class SocksAppAgent(Agent):
         DistVar('sizes', 1, "Sizes", "The size parameters to pass to the application (If applicable)"),
         StringVar('server_cmd',None,'Server Cmd', "The command to run on the servers"),
         StringVar('app_cmd',None, 'App Cmd','The application command to run.\n ${TARGET} will be interpolated with the appropriate value. ${SIZE} will be interpolated with a value chosen from the \'Sizes\' distribution.'),
-        StringVar('logpath',None,'Log Path', "The directory to log output to")
+        StringVar('logpath',None,'Log Path', "The directory to log output to"),
+        StringVar('seed',None,'Seed', "Workload schedules are derived from this and the node name (default the experiment name)"),
+        IntVar('duration',86400,'Duration', "Seconds of requests to schedule"),
+        StringVar('trace',None,'Trace',"A trace of '<offset> <destination> <command>' lines to replay instead of drawing from think ('-' runs app_cmd); ${NODE} is replaced by the node name"),
+        StringVar('collector',None,'Collector','host:port of the ExperimentRunner collector to acknowledge bundles to'),
+        StringVar('bundle',None,'Variable Bundle','JSON bundle of variable values, applied in one step before START (see safest/bundle.py)')
         ]
 
-    def install_packages(self, names):
-        """Use python-apt to install a list of packages, such as tor"""
-        # THIS ONLY WORKS ON UBUNTU
-        
-        self.log.info("Install packages")
-        
-        cache = apt.Cache()
-        
-        self.log.info("Updating apt cache")
-
-        try:
-            cache.update()
-        except Exception as e:
-            self.log.info("Failed to update the apt cache: %s" % str(e))
-            self.log.info("Are you running as root?")
-
-        cache.open(None)
-
-        self.log.info("Marking packages")
-
-        for name in names:
-            try:
-                pkg = cache[name]
-                
-                if not pkg.is_installed:
-                    self.log.info("Marking %s for installation" % name)
-                    pkg.mark_install()
-
-            except Exception as e:
-                self.log.info("Problem looking up or marking %s for installation: %s" % (name, str(e)))
-
-        self.log.info("Installing packages...")
-
-        try:
-            cache.commit()
-        except Exception as e:
-            self.log.info("Failed to install packages: %s" % str(e))
-            self.log.info("Are you running as root?")
-                       
-
-    def __init__(self): Agent.__init__(self)
+    def __init__(self):
+        Agent.__init__(self)
+        self.dests = None
 
     handleSTOP = Agent.TGStop
     def serverExec(self): 
@@ -117,8 +92,26 @@ class SocksAppAgent(Agent):
             self.log.info("Failed to kill server: %s"  % e)
             
 
+    def apply_bundle(self):
+        """Apply a newer variable bundle, if one was sent, and acknowledge it"""
+        try:
+            applied = bundle.apply(self, testbed.nodename)
+        except bundle.BundleError as e:
+            self.log.error(str(e))
+            return
+        if applied is not None and self.collector:
+            (version, tag) = applied
+            try:
+                collector.report(self.collector, 'bundle', testbed.nodename, {'version': version}, tag=tag)
+            except collector.CollectorError as e:
+                self.log.warning(str(e))
+
+    def handleAPPLY(self):
+        self.apply_bundle()
+
     def handleSTART(self):
-        self.install_packages(['dante-client'])
+        self.apply_bundle()
+        provision.ensure(self.log, testbed.experiment)
         
         if self.logpath:
             try:
@@ -137,19 +130,14 @@ class SocksAppAgent(Agent):
     def clientExec(self, src, dst, size):
         self.log.info("Starting")
 
-        ip_regex = re.compile('\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}')
-        if ip_regex.match(dst) is None:
-            dst2 = testbed.getIPForNode(dst)
-            #dst2 = "%s.%s.%s" % (dst, testbed.getExperiment(), testbed.getProject())
-            dst = dst2[0]
+        (dst, template) = self.dests.lookup(dst)
 
         self.log.info("Chose to download from %s" % dst)
 
         try:
-            t = Template(self.app_cmd)
-
+            t = template
             cmd = [u"tsocks"]
-            cmd.extend(t.safe_substitute(TARGET=dst).split())
+            cmd.extend(t.safe_substitute(SIZE=size).split())
 
             # We print this on stdout so it goes with redirected stdout
             self.log.info("Calling %s" % " ".join(cmd))
@@ -166,6 +154,65 @@ class SocksAppAgent(Agent):
         self.log.info("Curl finished with code %s" %ret)
         #subpid = spawn(cmd, self.log.info)
    
+    def clientInit(self):
+        Agent.clientInit(self)
+        self.dests = desttable.DestinationTable(self.servers or (), testbed.getIPForNode,
+                                                lambda ip: Template(Template(self.app_cmd).safe_substitute(TARGET=ip)),
+                                                self.traceDestinations())
+
+    def tracePath(self):
+        return Template(self.trace).safe_substitute(NODE=testbed.nodename)
+
+    def traceDestinations(self):
+        """The destinations our trace uses, so they go in the table up front"""
+        if not self.trace:
+            return ()
+        return trace.destinations(self.tracePath())
+
+    def destinationIPs(self):
+        return list(self.dests.hosts)
+
+    def makeSchedule(self, user=0):
+        """Precompute a user's requests from a seed derived from the experiment
+           and save them with our logs"""
+        hosts = self.destinationIPs()
+        seed = workload.node_seed(self.seed or testbed.experiment, testbed.nodename, user)
+        schedule = workload.closed_schedule(seed, self.think, self.sizes, hosts, self.duration)
+        path = "%s/%s.%d.schedule" % (self.logpath or '/tmp', testbed.getNodeName(), user)
+        schedule.save(path)
+        self.log.info("Scheduled %d requests for user %d with seed %d, saved to %s" % (len(schedule), user, seed, path))
+        if schedule.truncated:
+            self.log.warning("User %d's schedule was cut off at %d requests, it will end before %d seconds"
+                             % (user, len(schedule), self.duration))
+        return schedule
+
+    def scheduleLoop(self):
+        """Make the scheduled requests one after another"""
+        schedule = self.makeSchedule()
+        for i in xrange(len(schedule)):
+            (gap, size, host) = schedule.entry(i)
+            time.sleep(gap)
+            self.clientExec(None, host, size)
+
+    def replayLoop(self):
+        """Run the commands in our trace at their recorded times"""
+        path = self.tracePath()
+        self.log.info("Replaying %s" % path)
+
+        def issue(record):
+            (offset, dst, command) = record
+            (address, template) = self.dests.lookup(dst)
+            if command != '-':
+                template = Template(Template(command).safe_substitute(TARGET=address))
+            cmd = ["tsocks"]
+            cmd.extend(template.safe_substitute().split())
+            try:
+                Popen(cmd)
+            except OSError as e:
+                self.log.info("calling CMD failed: %s" % e)
+
+        trace.Replayer(path, issue, time.sleep, self.log).run()
+
     def TGStart(self): 
         if len(self.pids) > 0:
             self.log.info("Already running, not restarting")
@@ -215,15 +262,6 @@ class SocksAppAgent(Agent):
             writeout(fperr,"Forked child process as %s" % pid)
             signal.signal(signal.SIGCHLD, signal.SIG_IGN)
     
-            spool = AddressPool(testbed.nodename, services.RoutingService.getFake(testbed.nodename))
-            dpool = AddressPool()
-            if self.servers:
-                for s in self.servers:
-                    dst = testbed.getIPForNode(s)
-                    self.log.info("Adding '%s' to the destination pool" % dst)
-                    dpool.Set(s, [CIDR(inputstr=ip) for ip in dst])
-
-            
             if not self.logfilename:
                 logfile = "/local/logs/%s.%s" % (self.AGENTTYPE, self.group)
             else:
@@ -246,16 +284,10 @@ class SocksAppAgent(Agent):
         
             # Loop based on wait times
             try:
-                while (True):
-                    """
-                    if 'autoquit' in self.VARIABLES:
-                        elapsed = time.time() - starttime;
-                        if ((self.autoquit > 0) and (elapsed > self.autoquit)):
-                            os.killpg(0, signal.SIGTERM) # This should kill me and my children as I forked/setsid()
-                            return
-                    """
-        
-                    self.clientOneLoop(spool, dpool, self.think, self.sizes)
+                if self.trace:
+                    self.replayLoop()
+                    return
+                self.scheduleLoop()
     
             except Exception,e:
                 writeout(fperr,"error in client process: %s"% e);
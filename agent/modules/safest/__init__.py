@@ -0,0 +1,3 @@
+#
+# Support code shared by the SAFEST Tor and traffic agents.
+#
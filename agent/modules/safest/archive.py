@@ -0,0 +1,103 @@
+#
+# Streaming, compressed data collection for SAVE_DATA.
+#
+# Instead of copying /var/lib/tor file by file onto NFS, each node
+# writes one gzipped tar stream to a single file. Uploads can be rate
+# limited and staggered so every node doesn't hit the share at once.
+#
+
+import fnmatch
+import os
+import tarfile
+import time
+
+
+class RateLimitedFile(object):
+    """File wrapper that counts bytes and throttles writes to rate bytes/sec"""
+
+    def __init__(self, f, rate=None):
+        self.f = f
+        self.rate = rate
+        self.written = 0
+        self.started = time.time()
+
+    def write(self, data):
+        self.f.write(data)
+        self.written += len(data)
+        if self.rate:
+            ahead = float(self.written) / self.rate - (time.time() - self.started)
+            if ahead > 0:
+                time.sleep(ahead)
+
+    def tell(self):
+        return self.written
+
+
+def matches(name, patterns):
+    for pattern in patterns:
+        if fnmatch.fnmatch(name, pattern):
+            return True
+    return False
+
+
+def select(members, include=None, exclude=None, skip=()):
+    """Expand (path, arcname) members into the files to archive, keeping
+       arcnames that match include and not exclude, and paths not in skip"""
+    include = include or ['*']
+    exclude = exclude or []
+    skip = set([os.path.normpath(p) for p in skip])
+    selected = list()
+
+    def want(arcname, path):
+        return (matches(arcname, include) and not matches(arcname, exclude)
+                and os.path.normpath(path) not in skip)
+
+    for (path, arcname) in members:
+        if not os.path.exists(path):
+            continue
+        if not os.path.isdir(path):
+            if want(arcname, path):
+                selected.append((path, arcname))
+            continue
+        for (dirpath, dirnames, filenames) in os.walk(path):
+            rel = os.path.relpath(dirpath, path)
+            base = arcname if rel == '.' else os.path.join(arcname, rel)
+            for name in sorted(filenames):
+                member = os.path.normpath(os.path.join(base, name))
+                if want(member, os.path.join(dirpath, name)):
+                    selected.append((os.path.join(dirpath, name), member))
+    return selected
+
+
+def write(dest, members, include=None, exclude=None, rate=None, skip=()):
+    """Write members into a gzipped tar at dest in one sequential stream.
+       Returns (bytes written, seconds, files archived)."""
+    started = time.time()
+    files = select(members, include, exclude, skip)
+
+    parent = os.path.dirname(dest)
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+
+    tmp = "%s.tmp" % dest
+    f = open(tmp, 'wb')
+    try:
+        out = RateLimitedFile(f, rate)
+        tar = tarfile.open(fileobj=out, mode='w|gz')
+        for (path, arcname) in files:
+            tar.add(path, arcname, recursive=False)
+        tar.close()
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(tmp, dest)
+    return (out.written, time.time() - started, len(files))
+
+
+def stagger(node, nodes, window):
+    """Seconds node should wait so uploads spread evenly over window"""
+    nodes = sorted(set(nodes))
+    if not window or node not in nodes:
+        return 0
+    return float(window) * nodes.index(node) / len(nodes)
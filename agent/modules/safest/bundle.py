@@ -0,0 +1,91 @@
+#
+# Versioned variable bundles.
+#
+# Setting group variables one at a time sends one update per variable,
+# and a node can see a mix of old and new values if a command arrives
+# part way through. The runner instead encodes a group's whole variable
+# set as one JSON 'bundle' variable; the agent applies every value in
+# one step before handling a command and acknowledges the version.
+#
+# A bundle replaces the whole set. None values are sent explicitly, and
+# a variable an earlier bundle set that the new one leaves out goes back
+# to the value it had before any bundle was applied.
+#
+
+import json
+
+
+class BundleError(Exception):
+    pass
+
+
+class NodeList(list):
+    """Stands in for a NodeListVar value"""
+
+    def __init__(self, nodes, node=None):
+        list.__init__(self, nodes)
+        self.node = node
+
+    def myNodeMemberOf(self):
+        return self.node in self
+
+
+def encode(version, values, tag=None):
+    """JSON for a bundle. NodeList values are sent as node lists, other
+       lists as string lists, anything else (None included) as is."""
+    encoded = dict()
+    for (name, value) in values.items():
+        if isinstance(value, NodeList):
+            encoded[name] = ['nodes', list(value)]
+        elif isinstance(value, (list, tuple)):
+            encoded[name] = ['list', [str(v) for v in value]]
+        else:
+            encoded[name] = ['value', value]
+    return json.dumps({'version': version, 'tag': tag, 'vars': encoded}, sort_keys=True)
+
+
+def decode(text, node):
+    """(version, tag, {name: value}) from bundle JSON"""
+    try:
+        bundle = json.loads(text)
+        values = dict()
+        for (name, (kind, value)) in bundle['vars'].items():
+            if kind == 'nodes':
+                value = NodeList([str(n) for n in value], node)
+            elif kind == 'list':
+                value = [str(v) for v in value]
+            elif isinstance(value, unicode):
+                value = str(value)
+            values[str(name)] = value
+        return (bundle['version'], bundle.get('tag'), values)
+    except (ValueError, KeyError, TypeError) as e:
+        raise BundleError("Malformed bundle: %s" % e)
+
+
+def apply(agent, node):
+    """Apply agent.bundle if it is newer than the last one applied.
+       Returns (version, tag) when something was applied, else None."""
+    text = getattr(agent, 'bundle', None)
+    if not text:
+        return None
+    (version, tag, values) = decode(text, node)
+    if version <= getattr(agent, 'bundle_version', -1):
+        return None
+
+    # Remember each variable's value from before the first bundle that set
+    # it, and put back the ones this bundle leaves out
+    defaults = getattr(agent, 'bundle_defaults', None)
+    if defaults is None:
+        defaults = agent.bundle_defaults = dict()
+    for name in values:
+        if name not in defaults:
+            defaults[name] = getattr(agent, name, None)
+    for (name, default) in defaults.items():
+        if name not in values:
+            setattr(agent, name, default)
+
+    for (name, value) in values.items():
+        setattr(agent, name, value)
+    agent.bundle_version = version
+    agent.log.info("Applied variable bundle %s (%d variables)" % (version, len(values)))
+    return (version, tag)
@@ -0,0 +1,117 @@
+#
+# Result collection for the SAFEST agents.
+#
+# ExperimentRunner runs a Collector on the control node. Agents report()
+# small JSON messages to it (control port replies, readiness, phase
+# acknowledgements), each tagged with a kind and the sending node, and
+# the runner waits until every node it cares about has answered.
+#
+
+import SocketServer
+import json
+import socket
+import threading
+import time
+
+PORT = 9601
+
+
+class CollectorError(Exception):
+    pass
+
+
+class Collector(SocketServer.ThreadingTCPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port=PORT):
+        SocketServer.ThreadingTCPServer.__init__(self, ('', port), CollectorHandler)
+        self.results = dict()
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def add(self, kind, tag, node, data):
+        self.cond.acquire()
+        try:
+            self.results.setdefault((kind, tag), dict())[node] = data
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def clear(self, kind, tag=None):
+        self.cond.acquire()
+        try:
+            self.results.pop((kind, tag), None)
+        finally:
+            self.cond.release()
+
+    def get(self, kind, tag=None):
+        self.cond.acquire()
+        try:
+            return dict(self.results.get((kind, tag), dict()))
+        finally:
+            self.cond.release()
+
+    def wait(self, kind, nodes, tag=None, timeout=60, count=None):
+        """Wait for count (default: all) of nodes to report, returning
+           whatever has arrived when that happens or the timeout expires"""
+        nodes = set(nodes)
+        if count is None:
+            count = len(nodes)
+        deadline = time.time() + timeout
+        self.cond.acquire()
+        try:
+            while True:
+                got = self.results.get((kind, tag), dict())
+                if len(nodes.intersection(got)) >= count:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(min(remaining, 1))
+            return dict(self.results.get((kind, tag), dict()))
+        finally:
+            self.cond.release()
+
+
+class CollectorHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                msg = json.loads(line)
+                self.server.add(msg['kind'], msg.get('tag'), msg['node'], msg.get('data'))
+            except (ValueError, KeyError):
+                self.wfile.write("ERROR\n")
+            else:
+                self.wfile.write("OK\n")
+
+
+def report(address, kind, node, data=None, tag=None, timeout=10):
+    """Send one result to the collector at 'host:port'"""
+    if ':' in address:
+        (host, port) = address.rsplit(':', 1)
+    else:
+        (host, port) = (address, PORT)
+    try:
+        sock = socket.create_connection((host, int(port)), timeout)
+        try:
+            f = sock.makefile('r+')
+            f.write("%s\n" % json.dumps({'kind': kind, 'tag': tag, 'node': node, 'data': data}))
+            f.flush()
+            if f.readline().strip() != "OK":
+                raise CollectorError("Collector rejected %s report" % kind)
+        finally:
+            sock.close()
+    except socket.error as e:
+        raise CollectorError("Unable to report to collector at %s: %s" % (address, e))
@@ -0,0 +1,197 @@
+#
+# A small native client for the Tor control protocol.
+#
+# Connections are authenticated once and kept open for as long as the
+# tor process lives. Several commands can be pipelined in one batch and
+# full (multi-line) replies are returned.
+#
+
+import socket
+import threading
+
+
+class ControlError(Exception):
+    pass
+
+
+class Reply(object):
+    """One control port reply: a status code and its lines"""
+
+    def __init__(self, status, lines):
+        self.status = status
+        self.lines = lines
+
+    def ok(self):
+        return 200 <= self.status < 300
+
+    def __str__(self):
+        return "\n".join(self.lines)
+
+
+class ControlConnection(object):
+
+    def __init__(self, addr, port, password="", timeout=10):
+        self.addr = addr
+        self.port = int(port)
+        self.password = password
+        self.timeout = timeout
+        self.sock = None
+        self.rfile = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        try:
+            self.sock = socket.create_connection((self.addr, self.port), self.timeout)
+        except socket.error as e:
+            raise ControlError("Unable to connect to control port %s:%s: %s" % (self.addr, self.port, e))
+        self.rfile = self.sock.makefile('rb')
+        reply = self._exchange(['AUTHENTICATE "%s"' % self.password])[0]
+        if not reply.ok():
+            self.close()
+            raise ControlError("Authentication failed: %s" % reply)
+
+    def connected(self):
+        return self.sock is not None
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+        self.sock = None
+        self.rfile = None
+
+    def send(self, command):
+        """Send one command and return its Reply"""
+        return self.batch([command])[0]
+
+    def batch(self, commands):
+        """Pipeline several commands and return their replies in order"""
+        replies = list()
+        self.lock.acquire()
+        try:
+            if not self.connected():
+                self.connect()
+            try:
+                self._exchange(commands, replies)
+            except (socket.error, ControlError):
+                # The connection went stale (e.g. tor was restarted);
+                # retry once on a fresh one. Only the commands we have no
+                # reply to are sent again, so e.g. a SIGNAL NEWNYM that
+                # was answered isn't applied twice.
+                self.close()
+                self.connect()
+                self._exchange(commands[len(replies):], replies)
+            return replies
+        finally:
+            self.lock.release()
+
+    def _exchange(self, commands, replies=None):
+        """Send commands, appending their replies to replies as they arrive"""
+        if replies is None:
+            replies = list()
+        try:
+            self.sock.sendall("".join(["%s\r\n" % c for c in commands]))
+            for c in commands:
+                replies.append(self._read_reply())
+            return replies
+        except socket.error:
+            self.close()
+            raise
+
+    def _read_reply(self):
+        lines = list()
+        while True:
+            line = self._readline()
+            if len(line) < 4:
+                raise ControlError("Malformed reply line: %r" % line)
+            status = int(line[:3])
+            sep = line[3]
+            if status >= 600:
+                # Asynchronous event, not part of the reply
+                continue
+            lines.append(line[4:])
+            if sep == ' ':
+                return Reply(status, lines)
+            elif sep == '+':
+                while True:
+                    data = self._readline()
+                    if data == '.':
+                        break
+                    if data.startswith('..'):
+                        data = data[1:]
+                    lines.append(data)
+
+    def _readline(self):
+        line = self.rfile.readline()
+        if not line:
+            self.close()
+            raise ControlError("Control connection closed")
+        return line.rstrip("\r\n")
+
+
+_pool = dict()
+_pool_lock = threading.Lock()
+
+
+def get(addr, port, password=""):
+    """Return the pooled connection for addr:port, creating it if needed"""
+    key = (addr, int(port))
+    _pool_lock.acquire()
+    try:
+        conn = _pool.get(key)
+        if conn is None:
+            conn = ControlConnection(addr, port, password)
+            _pool[key] = conn
+        return conn
+    finally:
+        _pool_lock.release()
+
+
+def discard(addr, port):
+    """Close and forget the pooled connection for addr:port"""
+    _pool_lock.acquire()
+    try:
+        conn = _pool.pop((addr, int(port)), None)
+    finally:
+        _pool_lock.release()
+    if conn is not None:
+        conn.close()
+
+
+def split_commands(message):
+    """Split a ';' separated list of commands, leaving ';' inside double
+       quoted values alone"""
+    commands = list()
+    current = list()
+    quoted = False
+    escaped = False
+    for c in message:
+        if escaped:
+            escaped = False
+        elif c == '\\' and quoted:
+            escaped = True
+        elif c == '"':
+            quoted = not quoted
+        elif c == ';' and not quoted:
+            commands.append("".join(current))
+            current = list()
+            continue
+        current.append(c)
+    commands.append("".join(current))
+    return [c.strip() for c in commands if c.strip()]
+
+
+def find_control_port(config):
+    """Return (address, port) configured in torrc text, port is None if unset"""
+    port = None
+    addr = '127.0.0.1'
+    for line in config.splitlines():
+        if line.startswith("ControlPort"):
+            port = line.split()[1]
+            if ':' in port:
+                (addr, port) = port.rsplit(':', 1)
+        if line.startswith("ControlListenAddress"):
+            addr = line.split()[1]
+    return (addr, port)
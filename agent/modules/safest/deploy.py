@@ -0,0 +1,154 @@
+#
+# Content addressed deployment of the (modified) Tor binary.
+#
+# Binaries are fetched from NFS at most once per node into a local cache
+# named by their SHA1, and installed with an atomic rename so a running
+# tor never causes ETXTBSY. A small index remembers the digest for a
+# given (path, size, mtime), so an unchanged binary is never re-read.
+#
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+CACHE_DIR = "/var/cache/safest/tor"
+CHUNK = 1 << 20
+
+
+class DeployError(Exception):
+    pass
+
+
+class DeployResult(object):
+
+    def __init__(self, digest, changed, copied, seconds):
+        # copied counts the bytes fetched from the source, 0 if it was cached
+        self.digest = digest
+        self.changed = changed
+        self.copied = copied
+        self.seconds = seconds
+
+    def __str__(self):
+        if not self.changed:
+            return "%s already installed (%.2f seconds)" % (self.digest, self.seconds)
+        return "installed %s, fetched %d bytes in %.2f seconds" % (self.digest, self.copied, self.seconds)
+
+
+class BinaryCache(object):
+
+    def __init__(self, log, cache_dir=CACHE_DIR):
+        self.log = log
+        self.cache_dir = cache_dir
+        self.index_file = os.path.join(cache_dir, "index.json")
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.index = self.load_index()
+
+    def load_index(self):
+        try:
+            return json.load(open(self.index_file))
+        except (IOError, ValueError):
+            return dict()
+
+    def save_index(self):
+        tmp = "%s.tmp" % self.index_file
+        f = open(tmp, 'w')
+        json.dump(self.index, f)
+        f.close()
+        os.rename(tmp, self.index_file)
+
+    def key(self, path):
+        st = os.stat(path)
+        return "%s|%d|%d|%d" % (os.path.abspath(path), st.st_ino, st.st_size, int(st.st_mtime))
+
+    def digest(self, path):
+        """Digest of path, hashing it only if it changed since we last looked"""
+        key = self.key(path)
+        if key not in self.index:
+            self.index[key] = hash_file(path)
+            self.save_index()
+        return self.index[key]
+
+    def cached(self, digest):
+        return os.path.join(self.cache_dir, digest)
+
+    def fetch(self, source):
+        """Make sure source is in the local cache, returns (digest, bytes copied)"""
+        key = self.key(source)
+        digest = self.index.get(key)
+        if digest is not None and os.path.exists(self.cached(digest)):
+            return (digest, 0)
+
+        self.log.info("Fetching %s into %s" % (source, self.cache_dir))
+        tmp = os.path.join(self.cache_dir, "fetch.%s.tmp" % os.getpid())
+        (digest, copied) = copy_hashing(source, tmp)
+        os.rename(tmp, self.cached(digest))
+        self.index[key] = digest
+        self.save_index()
+        return (digest, copied)
+
+
+def hash_file(path):
+    h = hashlib.sha1()
+    f = open(path, 'rb')
+    try:
+        while True:
+            data = f.read(CHUNK)
+            if not data:
+                break
+            h.update(data)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+
+def copy_hashing(source, dest):
+    """Copy source to dest in one pass, returning (sha1, bytes)"""
+    h = hashlib.sha1()
+    copied = 0
+    src = open(source, 'rb')
+    dst = open(dest, 'wb')
+    try:
+        while True:
+            data = src.read(CHUNK)
+            if not data:
+                break
+            h.update(data)
+            dst.write(data)
+            copied += len(data)
+        dst.flush()
+        os.fsync(dst.fileno())
+    finally:
+        src.close()
+        dst.close()
+    return (h.hexdigest(), copied)
+
+
+def install(source, dest, log, cache_dir=CACHE_DIR):
+    """Install source at dest unless the same content is already there"""
+    started = time.time()
+    try:
+        cache = BinaryCache(log, cache_dir)
+        (digest, copied) = cache.fetch(source)
+
+        if os.path.exists(dest) and cache.digest(dest) == digest:
+            return DeployResult(digest, False, copied, time.time() - started)
+
+        tmp = "%s.%s.tmp" % (dest, os.getpid())
+        copy_hashing(cache.cached(digest), tmp)
+        if os.path.exists(dest):
+            st = os.stat(dest)
+            shutil.copymode(dest, tmp)
+            os.chown(tmp, st.st_uid, st.st_gid)
+        else:
+            os.chmod(tmp, 0755)
+        # rename() replaces the directory entry, so a running tor keeps
+        # its old inode and we never hit ETXTBSY.
+        os.rename(tmp, dest)
+        cache.digest(dest)
+    except (IOError, OSError) as e:
+        raise DeployError("Failed to install %s as %s: %s" % (source, dest, e))
+
+    return DeployResult(digest, True, copied, time.time() - started)
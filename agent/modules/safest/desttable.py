@@ -0,0 +1,49 @@
+#
+# Destination lookup for the traffic agents.
+#
+# The traffic controllers used to work out each request's destination
+# from scratch: compile an IP regex, then ask the testbed for the node's
+# addresses. A DestinationTable is built once when the controller starts,
+# resolving every server and every other destination it will be asked
+# for (e.g. those in a trace), and keeps whatever per-destination value
+# the agent renders (a URL prefix, a command template) alongside the
+# address. Per request lookups only index into it.
+#
+
+import re
+
+IP_RE = re.compile(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$')
+
+
+class DestinationTable(object):
+    """Maps destination names and addresses to (preferred address, rendered).
+       hosts are the servers' preferred addresses. Build a new table when
+       the servers change."""
+
+    def __init__(self, servers, resolve, render, others=()):
+        self.resolve = resolve
+        self.render = render
+        self.entries = dict()
+        hosts = list()
+        for name in servers:
+            hosts.append(self.add(name)[0])
+        self.hosts = tuple(hosts)
+        for name in others:
+            if name not in self.entries:
+                self.add(name)
+
+    def addresses_of(self, dst):
+        if IP_RE.match(dst):
+            return [dst]
+        return self.resolve(dst)
+
+    def add(self, dst):
+        address = self.addresses_of(dst)[0]
+        entry = (address, self.render(address))
+        self.entries[dst] = entry
+        self.entries.setdefault(address, entry)
+        return entry
+
+    def lookup(self, dst):
+        """(address, rendered) for dst"""
+        return self.entries[dst]
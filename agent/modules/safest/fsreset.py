@@ -0,0 +1,61 @@
+#
+# Fast reset of a directory tree by rename-and-reap.
+#
+# The old tree is renamed aside (one metadata operation), a fresh
+# directory is created in its place and anything worth keeping is
+# renamed back into it. The aside tree is deleted by a background
+# thread, so callers never wait on the unlinks.
+#
+
+import glob
+import os
+import shutil
+import threading
+import time
+
+
+def reap(path):
+    """Delete path in the background"""
+    t = threading.Thread(target=shutil.rmtree, args=(path, True))
+    t.setDaemon(True)
+    t.start()
+    return t
+
+
+def reap_stale(path):
+    """Reap trees left aside by earlier resets that never got deleted"""
+    for stale in glob.glob("%s.reap.*" % path):
+        reap(stale)
+
+
+def reset(path, uid=0, gid=0, mode=0700, keep=()):
+    """Replace path with an empty directory owned by uid:gid, carrying over
+       the entries named in keep. Returns the seconds spent in the caller."""
+    started = time.time()
+    reap_stale(path)
+
+    aside = None
+    if os.path.exists(path):
+        aside = "%s.reap.%d.%d" % (path, os.getpid(), int(started * 1000))
+        os.rename(path, aside)
+
+    os.makedirs(path, mode)
+    os.chown(path, uid, gid)
+
+    if aside is not None:
+        for name in keep:
+            if os.path.lexists(os.path.join(aside, name)):
+                os.rename(os.path.join(aside, name), os.path.join(path, name))
+        reap(aside)
+
+    return time.time() - started
+
+
+def chown_tree(path, uid=0, gid=0):
+    """chown -R without forking"""
+    if not os.path.exists(path):
+        return
+    os.chown(path, uid, gid)
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for name in dirnames + filenames:
+            os.lchown(os.path.join(dirpath, name), uid, gid)
@@ -0,0 +1,170 @@
+#
+# Persistent key store for Tor directory authorities.
+#
+# Identity, authority and signing keys are generated once per node and
+# experiment and kept under <root>/<experiment>/<node>. The v3ident and
+# relay fingerprint are read straight out of the key files, so starting
+# an authority no longer needs tor-gencert or a throwaway tor process.
+#
+
+from subprocess import Popen, PIPE
+import calendar
+import hashlib
+import os
+import re
+import shutil
+import time
+
+import pexpect
+
+TOR_GENCERT = "/usr/bin/tor-gencert"
+OPENSSL = "/usr/bin/openssl"
+PASSPHRASE = "asdf"
+
+KEY_FILES = ['secret_id_key', 'authority_identity_key', 'authority_signing_key', 'authority_certificate']
+
+# Regenerate certificates that expire within this many seconds
+EXPIRY_MARGIN = 24 * 60 * 60
+
+
+class KeyStoreError(Exception):
+    pass
+
+
+class AuthorityKeys(object):
+    """The key files for one authority along with its identities"""
+
+    def __init__(self, path, v3ident, fingerprint):
+        self.path = path
+        self.v3ident = v3ident
+        self.fingerprint = fingerprint
+
+    def install(self, keydir):
+        """Copy the keys into a Tor data directory's key directory"""
+        if not os.path.exists(keydir):
+            os.makedirs(keydir)
+        os.chmod(keydir, 0700)
+        for name in KEY_FILES:
+            dest = os.path.join(keydir, name)
+            shutil.copyfile(os.path.join(self.path, name), dest)
+            os.chmod(dest, 0600)
+
+
+class KeyStore(object):
+
+    def __init__(self, root, log):
+        self.root = root
+        self.log = log
+
+    def path_for(self, experiment, node):
+        return os.path.join(self.root, experiment, node)
+
+    def ensure(self, experiment, node):
+        """Return the AuthorityKeys for node, generating them if needed"""
+        path = self.path_for(experiment, node)
+        if not self.valid(path):
+            self.generate(path)
+        return AuthorityKeys(path, v3ident(path), fingerprint(path))
+
+    def valid(self, path):
+        for name in KEY_FILES:
+            if not os.path.exists(os.path.join(path, name)):
+                return False
+        try:
+            expires = certificate_expiry(path)
+        except KeyStoreError as e:
+            self.log.warning("Discarding cached keys in %s: %s" % (path, e))
+            return False
+        if expires - EXPIRY_MARGIN < time.time():
+            self.log.info("Cached authority certificate in %s has expired" % path)
+            return False
+        return True
+
+    def generate(self, path):
+        """Generate a full key set into path, replacing any existing one"""
+        self.log.info("Generating authority keys in %s" % path)
+        started = time.time()
+
+        parent = os.path.dirname(path)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        tmp = "%s.%s.tmp" % (path, os.getpid())
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.mkdir(tmp, 0700)
+
+        try:
+            run([OPENSSL, 'genrsa', '-out', os.path.join(tmp, 'secret_id_key'), '1024'])
+
+            child = pexpect.spawn("%s --create-identity-key" % TOR_GENCERT, cwd=tmp)
+            child.expect("Enter PEM pass phrase:", timeout=120)
+            child.sendline(PASSPHRASE)
+            child.expect("Verifying - Enter PEM pass phrase:", timeout=120)
+            child.sendline(PASSPHRASE)
+            # If we don't wait for EOF, we get no keys!
+            child.expect(pexpect.EOF, timeout=120)
+        except Exception as e:
+            shutil.rmtree(tmp, True)
+            raise KeyStoreError("Failed to generate authority keys: %s" % e)
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp, path)
+        self.log.info("Generated authority keys for %s in %.1f seconds" % (path, time.time() - started))
+
+
+def run(cmd):
+    p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+    (out, err) = p.communicate()
+    if p.returncode != 0:
+        raise KeyStoreError("'%s' returned %s: %s" % (" ".join(cmd), p.returncode, err.strip()))
+    return out
+
+
+def v3ident(path):
+    """The v3 identity digest, as listed in the authority certificate"""
+    cert = open(os.path.join(path, 'authority_certificate')).read()
+    match = re.search(r"^fingerprint (\w+)", cert, re.MULTILINE)
+    if match is None:
+        raise KeyStoreError("No fingerprint in %s/authority_certificate" % path)
+    return match.group(1)
+
+
+def certificate_expiry(path):
+    cert = open(os.path.join(path, 'authority_certificate')).read()
+    match = re.search(r"^dir-key-expires (\S+ \S+)", cert, re.MULTILINE)
+    if match is None:
+        raise KeyStoreError("No expiry in %s/authority_certificate" % path)
+    return calendar.timegm(time.strptime(match.group(1), "%Y-%m-%d %H:%M:%S"))
+
+
+def fingerprint(path):
+    """The relay fingerprint, formatted the way tor --list-fingerprint does"""
+    spki = run([OPENSSL, 'rsa', '-in', os.path.join(path, 'secret_id_key'), '-pubout', '-outform', 'DER'])
+    digest = hashlib.sha1(rsa_public_key(spki)).hexdigest().upper()
+    return " ".join([digest[i:i + 4] for i in range(0, len(digest), 4)])
+
+
+def rsa_public_key(spki):
+    """Pull the PKCS#1 RSAPublicKey out of a DER SubjectPublicKeyInfo.
+       Tor fingerprints are the SHA1 of the PKCS#1 encoding."""
+    (start, end) = _der_element(spki, 0, 0x30)
+    (alg_start, alg_end) = _der_element(spki, start, 0x30)
+    (bits_start, bits_end) = _der_element(spki, alg_end, 0x03)
+    # The first content byte of a BIT STRING is the count of unused bits
+    return spki[bits_start + 1:bits_end]
+
+
+def _der_element(data, pos, tag):
+    """Return the (start, end) of the content of the DER element at pos"""
+    if ord(data[pos]) != tag:
+        raise KeyStoreError("Unexpected DER tag %#x at %d" % (ord(data[pos]), pos))
+    length = ord(data[pos + 1])
+    pos += 2
+    if length & 0x80:
+        count = length & 0x7f
+        length = 0
+        for c in data[pos:pos + count]:
+            length = (length << 8) | ord(c)
+        pos += count
+    return (pos, pos + length)
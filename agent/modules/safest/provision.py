@@ -0,0 +1,150 @@
+#
+# Package provisioning shared by the SAFEST agents.
+#
+# Every agent registers the packages it needs with require() when its
+# module is loaded. The first agent to call ensure() on a node installs
+# everything that is missing in a single transaction; after that a stamp
+# file makes the rest of the experiment batch a no-op. Installed state
+# is read from the dpkg status file, so a warm node never touches apt.
+#
+
+from subprocess import Popen, PIPE
+import glob
+import os
+import threading
+
+DPKG_STATUS = "/var/lib/dpkg/status"
+DEB_DIRS = ['/var/cache/safest/debs']
+STAMP_DIR = "/var/run/safest"
+
+_required = set()
+_lock = threading.Lock()
+
+
+def require(*names):
+    """Register packages that an agent on this node needs"""
+    _required.update(names)
+
+
+def installed_packages():
+    """The set of packages dpkg reports as installed"""
+    installed = set()
+    name = None
+    f = open(DPKG_STATUS)
+    try:
+        for line in f:
+            if line.startswith("Package: "):
+                name = line[9:].strip()
+            elif line.startswith("Status: ") and name is not None:
+                if line.split()[-1] == "installed":
+                    installed.add(name)
+    finally:
+        f.close()
+    return installed
+
+
+def stamp_path(batch):
+    return os.path.join(STAMP_DIR, "provisioned.%s" % batch)
+
+
+def read_stamp(batch):
+    try:
+        return set(open(stamp_path(batch)).read().split())
+    except IOError:
+        return set()
+
+
+def write_stamp(batch, names):
+    if not os.path.exists(STAMP_DIR):
+        os.makedirs(STAMP_DIR)
+    f = open(stamp_path(batch), 'w')
+    f.write("\n".join(sorted(names)))
+    f.close()
+
+
+def ensure(log, batch, names=(), deb_dirs=None):
+    """Make sure every required package is installed, at most once per batch"""
+    needed = set(_required)
+    needed.update(names)
+
+    _lock.acquire()
+    try:
+        if needed <= read_stamp(batch):
+            return
+
+        missing = needed - installed_packages()
+        if missing:
+            log.info("Missing packages: %s" % ", ".join(sorted(missing)))
+            install_debs(log, missing, deb_dirs or DEB_DIRS)
+            missing = needed - installed_packages()
+        if missing:
+            install_apt(log, missing)
+            missing = needed - installed_packages()
+
+        if missing:
+            log.warning("Failed to install packages: %s" % ", ".join(sorted(missing)))
+        else:
+            write_stamp(batch, needed)
+    finally:
+        _lock.release()
+
+
+def install_debs(log, names, deb_dirs):
+    """Install whatever we can from local .deb caches with one dpkg run"""
+    debs = list()
+    for name in names:
+        for d in deb_dirs:
+            found = glob.glob(os.path.join(d, "%s_*.deb" % name))
+            if found:
+                found.sort()
+                debs.append(found[-1])
+                break
+    if not debs:
+        return
+
+    log.info("Installing from local package cache: %s" % " ".join(debs))
+    p = Popen(['dpkg', '-i'] + debs, stdout=PIPE, stderr=PIPE)
+    (out, err) = p.communicate()
+    if p.returncode != 0:
+        log.warning("dpkg returned %s: %s" % (p.returncode, err.strip()))
+
+
+def install_apt(log, names):
+    """Use python-apt to install a list of packages, only refreshing the
+       package lists if something can't be found in them"""
+    # THIS ONLY WORKS ON UBUNTU
+    import apt
+
+    cache = apt.Cache()
+    if not mark(log, cache, names, False):
+        log.info("Updating apt cache")
+        try:
+            cache.update()
+        except Exception as e:
+            log.info("Failed to update the apt cache: %s" % str(e))
+            log.info("Are you running as root?")
+        cache.open(None)
+        mark(log, cache, names, True)
+
+    log.info("Installing packages...")
+    try:
+        cache.commit()
+    except Exception as e:
+        log.info("Failed to install packages: %s" % str(e))
+        log.info("Are you running as root?")
+
+
+def mark(log, cache, names, complain):
+    """Mark names for installation, returning False if any are unknown"""
+    found = True
+    for name in names:
+        try:
+            pkg = cache[name]
+            if not pkg.is_installed:
+                log.info("Marking %s for installation" % name)
+                pkg.mark_install()
+        except Exception as e:
+            found = False
+            if complain:
+                log.info("Problem looking up or marking %s for installation: %s" % (name, str(e)))
+    return found
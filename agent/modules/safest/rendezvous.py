@@ -0,0 +1,274 @@
+#
+# Directory line rendezvous for SAFEST Tor networks.
+#
+# One directory authority runs a small TCP service. Every authority
+# PUBLISHes its DirServer line to it, and every relay, client and
+# authority WAITs on it. Waiters are released the moment the last
+# authority has published, instead of polling a file on NFS.
+#
+# An authority that can't reach the service appends its line to the
+# shared dirfile under the old NFS lock instead. One poller thread in
+# the service merges those lines into its set, so they still count, and
+# once the set is complete the service writes every line to the dirfile
+# so nodes that can't reach it can use the old file based exchange.
+#
+
+import SocketServer
+import os
+import socket
+import threading
+import time
+
+PORT = 9600
+
+# How often the service checks the dirfile for lines published there
+FALLBACK_POLL = 2
+
+
+class RendezvousError(Exception):
+    pass
+
+
+class RendezvousServer(SocketServer.ThreadingTCPServer):
+    """Collects DirServer lines and releases waiters once all are in"""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, publishers, subscribers, log, fallback_file=None,
+                 fallback_sem=None, fallback_lock=None, port=PORT):
+        SocketServer.ThreadingTCPServer.__init__(self, ('', port), RendezvousHandler)
+        self.publishers = publishers
+        self.subscribers = subscribers
+        self.log = log
+        self.fallback_file = fallback_file
+        self.fallback_sem = fallback_sem
+        self.fallback_lock = fallback_lock
+        self.lines = dict()
+        self.released = set()
+        self.first_publish = None
+        self.last_release = None
+        self.cond = threading.Condition()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.poller = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        if self.fallback_file:
+            self.poller = threading.Thread(target=self.poll_fallback)
+            self.poller.setDaemon(True)
+            self.poller.start()
+        self.log.info("Directory rendezvous listening on port %s (%d authorities, %d subscribers)"
+                      % (self.server_address[1], self.publishers, self.subscribers))
+
+    def stop(self):
+        self.stopping.set()
+        self.wakeup.set()
+        self.shutdown()
+        self.server_close()
+        if self.poller is not None:
+            self.poller.join()
+
+    def complete(self):
+        return len(self.lines) >= self.publishers
+
+    def dirline(self):
+        names = self.lines.keys()
+        names.sort()
+        return "".join(["%s\n" % self.lines[name] for name in names])
+
+    def publish(self, name, line):
+        self.cond.acquire()
+        try:
+            if self.first_publish is None:
+                self.first_publish = time.time()
+            self.lines[name] = line
+            self.log.info("Rendezvous: %s published (%d/%d)" % (name, len(self.lines), self.publishers))
+            if self.complete():
+                self.cond.notifyAll()
+                self.wakeup.set()
+        finally:
+            self.cond.release()
+
+    def wait(self, name, timeout):
+        deadline = time.time() + timeout
+        self.cond.acquire()
+        try:
+            while not self.complete():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+
+            self.released.add(name)
+            if len(self.released) >= self.subscribers and self.last_release is None:
+                self.last_release = time.time()
+                self.log.info("Rendezvous: all %d subscribers released %.2f seconds after first publish"
+                              % (len(self.released), self.settle_time()))
+            return self.dirline()
+        finally:
+            self.cond.release()
+
+    def settle_time(self):
+        """Seconds from the first publish to the last subscriber being released"""
+        if self.first_publish is None or self.last_release is None:
+            return None
+        return self.last_release - self.first_publish
+
+    def poll_fallback(self):
+        """Merge the dirfile's lines every FALLBACK_POLL seconds until the
+           set is complete, then write the whole set to it"""
+        while not self.stopping.isSet():
+            if self.complete():
+                self.write_fallback()
+                return
+            self.merge_fallback()
+            self.wakeup.wait(FALLBACK_POLL)
+
+    def merge_fallback(self):
+        """Add lines authorities wrote to the dirfile instead of publishing
+           to us"""
+        try:
+            f = open(self.fallback_file)
+            try:
+                data = f.read()
+            finally:
+                f.close()
+        except IOError:
+            return
+
+        self.cond.acquire()
+        try:
+            # Only take whole lines, one may be in the middle of being appended
+            for line in data.split("\n")[:-1]:
+                parts = line.split()
+                if len(parts) < 2 or parts[0] != "DirServer" or parts[1] in self.lines:
+                    continue
+                if self.first_publish is None:
+                    self.first_publish = time.time()
+                self.lines[parts[1]] = line.strip()
+                self.log.info("Rendezvous: %s merged from %s (%d/%d)" % (parts[1], self.fallback_file,
+                                                                        len(self.lines), self.publishers))
+            if self.complete():
+                self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def write_fallback(self):
+        """Replace the dirfile with the complete set and clear its semaphore,
+           under the dirfile lock so an authority writing it can't interleave"""
+        self.cond.acquire()
+        try:
+            dirline = self.dirline()
+        finally:
+            self.cond.release()
+
+        if self.fallback_lock is not None:
+            self.fallback_lock.lock()
+        try:
+            tmp = "%s.%s.tmp" % (self.fallback_file, os.getpid())
+            f = open(tmp, 'w')
+            f.write(dirline)
+            f.close()
+            os.rename(tmp, self.fallback_file)
+            if self.fallback_sem and os.path.exists(self.fallback_sem):
+                os.remove(self.fallback_sem)
+        except (IOError, OSError) as e:
+            self.log.warning("Rendezvous: failed to write fallback dirfile %s: %s" % (self.fallback_file, e))
+        finally:
+            if self.fallback_lock is not None:
+                self.fallback_lock.unlock()
+
+
+class RendezvousHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline().strip()
+        parts = line.split(None, 2)
+        if not parts:
+            return
+        cmd = parts[0].upper()
+        server = self.server
+
+        if cmd == 'PUBLISH' and len(parts) == 3:
+            server.publish(parts[1], parts[2])
+            self.wfile.write("OK\n")
+        elif cmd == 'WAIT' and len(parts) >= 2:
+            timeout = float(parts[2]) if len(parts) == 3 else 120
+            dirline = server.wait(parts[1], timeout)
+            if dirline is None:
+                self.wfile.write("TIMEOUT\n")
+            else:
+                self.wfile.write("LINES\n%s.\n" % dirline)
+        elif cmd == 'STATS':
+            self.wfile.write("%s %s %d %d\n" % (server.first_publish, server.last_release,
+                                                len(server.released), server.subscribers))
+        else:
+            self.wfile.write("ERROR unknown command\n")
+
+
+def _connect(host, port, timeout):
+    """Connect to the rendezvous service, retrying until it comes up"""
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return socket.create_connection((host, port), timeout)
+        except socket.error as e:
+            if time.time() > deadline:
+                raise RendezvousError("Unable to reach rendezvous at %s:%s: %s" % (host, port, e))
+            time.sleep(0.5)
+
+
+def publish(host, name, line, port=PORT, timeout=60):
+    """Publish our DirServer line"""
+    sock = _connect(host, port, timeout)
+    try:
+        f = sock.makefile('r+')
+        f.write("PUBLISH %s %s\n" % (name, line.strip()))
+        f.flush()
+        reply = f.readline().strip()
+        if reply != "OK":
+            raise RendezvousError("Publish rejected: %s" % reply)
+    finally:
+        sock.close()
+
+
+def wait(host, name, port=PORT, timeout=120):
+    """Block until every authority has published, and return the lines"""
+    sock = _connect(host, port, timeout)
+    try:
+        sock.settimeout(timeout + 10)
+        f = sock.makefile('r+')
+        f.write("WAIT %s %s\n" % (name, timeout))
+        f.flush()
+        reply = f.readline().strip()
+        if reply != "LINES":
+            raise RendezvousError("Wait failed: %s" % reply)
+        lines = list()
+        for line in f:
+            if line.strip() == '.':
+                return "".join(lines)
+            lines.append(line)
+        raise RendezvousError("Connection closed before all lines were received")
+    except socket.error as e:
+        raise RendezvousError("Wait failed: %s" % e)
+    finally:
+        sock.close()
+
+
+def stats(host, port=PORT, timeout=10):
+    """Return (first_publish, last_release, released, subscribers) from the service"""
+    sock = _connect(host, port, timeout)
+    try:
+        f = sock.makefile('r+')
+        f.write("STATS\n")
+        f.flush()
+        (first, last, released, subscribers) = f.readline().split()
+        conv = lambda v: None if v == 'None' else float(v)
+        return (conv(first), conv(last), int(released), int(subscribers))
+    finally:
+        sock.close()
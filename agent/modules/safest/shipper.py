@@ -0,0 +1,134 @@
+#
+# Incremental shipping of logs and state files during a run.
+#
+# A Shipper thread wakes up every interval seconds and appends whatever
+# has been written to each tailed file since the last pass to a copy in
+# the results location. Snapshot files (which are rewritten rather than
+# appended to) are copied whole whenever they change. The copies mirror
+# the source paths under the destination directory.
+#
+
+import glob
+import json
+import os
+import shutil
+import threading
+import time
+
+CHUNK = 1 << 20
+
+
+class Shipper(threading.Thread):
+
+    def __init__(self, dest, tail, snapshot, log, interval=60):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.dest = dest
+        self.tail = tail or []
+        self.snapshot = snapshot or []
+        self.log = log
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.offsets_file = os.path.join(dest, ".offsets")
+        self.offsets = dict()
+        self.shipped = 0
+        self.seconds = 0.0
+        if os.path.exists(self.offsets_file):
+            try:
+                self.offsets = json.load(open(self.offsets_file))
+            except ValueError:
+                pass
+
+    def run(self):
+        while not self.stopped.isSet():
+            self.stopped.wait(self.interval)
+            try:
+                self.ship()
+            except Exception as e:
+                self.log.warning("Shipping failed: %s" % e)
+
+    def finish(self):
+        """Stop the thread and ship whatever is left. Returns the source
+           paths that have been shipped."""
+        self.stopped.set()
+        if self.isAlive():
+            self.join()
+        self.ship()
+        self.log.info("Shipped %d bytes to %s in %.2f seconds of I/O" % (self.shipped, self.dest, self.seconds))
+        return self.offsets.keys()
+
+    def sources(self, patterns):
+        found = list()
+        for pattern in patterns:
+            found.extend(glob.glob(pattern))
+        return found
+
+    def target(self, path):
+        return os.path.join(self.dest, path.lstrip('/'))
+
+    def ship(self):
+        self.lock.acquire()
+        try:
+            started = time.time()
+            for path in self.sources(self.tail):
+                self.ship_tail(path)
+            for path in self.sources(self.snapshot):
+                self.ship_snapshot(path)
+            self.save_offsets()
+            self.seconds += time.time() - started
+        finally:
+            self.lock.release()
+
+    def ship_tail(self, path):
+        """Append the bytes of path we haven't shipped yet"""
+        size = os.path.getsize(path)
+        offset = self.offsets.get(path, 0)
+        if size < offset:
+            # Truncated or replaced; start the copy over
+            offset = 0
+        if size == offset and os.path.exists(self.target(path)):
+            return
+
+        target = self.target(path)
+        self.ensure_dir(target)
+        src = open(path, 'rb')
+        dst = open(target, 'ab' if offset > 0 else 'wb')
+        try:
+            src.seek(offset)
+            while True:
+                data = src.read(CHUNK)
+                if not data:
+                    break
+                dst.write(data)
+                offset += len(data)
+                self.shipped += len(data)
+        finally:
+            src.close()
+            dst.close()
+        self.offsets[path] = offset
+
+    def ship_snapshot(self, path):
+        """Copy path whole if it changed since the last pass"""
+        mtime = os.path.getmtime(path)
+        if self.offsets.get(path) == mtime:
+            return
+        target = self.target(path)
+        self.ensure_dir(target)
+        shutil.copyfile(path, "%s.tmp" % target)
+        os.rename("%s.tmp" % target, target)
+        self.shipped += os.path.getsize(target)
+        self.offsets[path] = mtime
+
+    def ensure_dir(self, target):
+        parent = os.path.dirname(target)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+
+    def save_offsets(self):
+        if not os.path.exists(self.dest):
+            return
+        f = open("%s.tmp" % self.offsets_file, 'w')
+        json.dump(self.offsets, f)
+        f.close()
+        os.rename("%s.tmp" % self.offsets_file, self.offsets_file)
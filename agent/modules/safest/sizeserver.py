@@ -0,0 +1,175 @@
+#
+# Built-in content server for the proxied web workload.
+#
+# Answers the same '/getsize.py?length=N' requests as the Apache CGI
+# script, but from one poll() loop in a thread: the body is N bytes cut
+# from a payload generated once into an anonymous mmap and sent as
+# buffer() slices of it, so serving a request copies nothing in Python
+# and forks nothing. Each request's serve time is logged.
+#
+
+import errno
+import mmap
+import select
+import socket
+import threading
+import time
+import urlparse
+
+PAYLOAD_SIZE = 1 << 20
+MAX_REQUEST = 8192
+BACKLOG = 128
+
+
+class Connection(object):
+
+    def __init__(self, sock, peer):
+        self.sock = sock
+        self.peer = peer
+        self.started = time.time()
+        self.request = ''
+        self.header = None
+        self.status = None
+        self.length = 0
+        self.sent = 0
+
+    def events(self):
+        if self.header is None:
+            return select.POLLIN
+        return select.POLLOUT
+
+
+class SizeServer(threading.Thread):
+
+    def __init__(self, port=80, log=None, logfile=None, payload_size=PAYLOAD_SIZE):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.port = port
+        self.log = log
+        self.logfile = logfile
+        self.payload_size = payload_size
+        self.payload = mmap.mmap(-1, payload_size)
+        pattern = "".join([chr(ord('a') + i % 26) for i in xrange(4096)])
+        for offset in xrange(0, payload_size, len(pattern)):
+            self.payload[offset:offset + len(pattern)] = pattern[:payload_size - offset]
+        self.stopped = threading.Event()
+        self.conns = dict()
+        self.served = 0
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.listener.bind(('', port))
+            self.listener.listen(BACKLOG)
+        except socket.error:
+            self.listener.close()
+            raise
+        self.listener.setblocking(0)
+        self.poller = select.poll()
+        self.poller.register(self.listener.fileno(), select.POLLIN)
+
+    def stop(self):
+        self.stopped.set()
+        if self.isAlive():
+            self.join()
+
+    def run(self):
+        out = None
+        if self.logfile:
+            out = open(self.logfile, 'a')
+        try:
+            while not self.stopped.isSet():
+                for (fd, event) in self.poller.poll(500):
+                    if fd == self.listener.fileno():
+                        self.accept()
+                        continue
+                    conn = self.conns.get(fd)
+                    if conn is None:
+                        continue
+                    try:
+                        if conn.header is None:
+                            self.read(conn)
+                        else:
+                            self.write(conn)
+                    except socket.error as e:
+                        if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            continue
+                        self.close(conn)
+                        continue
+                    if conn.header is not None and conn.sent >= len(conn.header) + conn.length:
+                        self.close(conn)
+                        self.served += 1
+                        if out is not None:
+                            out.write("%d %s %d %d %.6f\n" % (int(conn.started), conn.peer[0], conn.status,
+                                                              conn.length, time.time() - conn.started))
+                    elif fd in self.conns:
+                        self.poller.modify(fd, conn.events())
+        finally:
+            for conn in self.conns.values():
+                self.close(conn)
+            self.poller.unregister(self.listener.fileno())
+            self.listener.close()
+            if out is not None:
+                out.close()
+            if self.log is not None:
+                self.log.info("Size server on port %d stopped after %d requests" % (self.port, self.served))
+
+    def accept(self):
+        while True:
+            try:
+                (sock, peer) = self.listener.accept()
+            except socket.error as e:
+                if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            sock.setblocking(0)
+            conn = Connection(sock, peer)
+            self.conns[sock.fileno()] = conn
+            self.poller.register(sock.fileno(), conn.events())
+
+    def read(self, conn):
+        data = conn.sock.recv(MAX_REQUEST)
+        if not data:
+            self.close(conn)
+            return
+        conn.request += data
+        if "\r\n\r\n" not in conn.request and "\n\n" not in conn.request:
+            if len(conn.request) > MAX_REQUEST:
+                self.respond(conn, 400, "Bad Request")
+            return
+        conn.started = time.time()
+        try:
+            (method, target) = conn.request.split(None, 2)[:2]
+            url = urlparse.urlparse(target)
+            length = int(urlparse.parse_qs(url.query)['length'][0])
+            if method not in ('GET', 'HEAD') or length < 0:
+                raise ValueError
+        except (ValueError, KeyError, IndexError):
+            self.respond(conn, 400, "Bad Request")
+            return
+        if method == 'HEAD':
+            self.respond(conn, 200, "OK", length, body=False)
+        else:
+            self.respond(conn, 200, "OK", length)
+
+    def respond(self, conn, status, reason, length=0, body=True):
+        conn.status = status
+        conn.header = ("HTTP/1.0 %d %s\r\nContent-Type: application/octet-stream\r\n"
+                       "Content-Length: %d\r\nConnection: close\r\n\r\n" % (status, reason, length))
+        if body:
+            conn.length = length
+
+    def write(self, conn):
+        if conn.sent < len(conn.header):
+            conn.sent += conn.sock.send(conn.header[conn.sent:])
+            return
+        done = conn.sent - len(conn.header)
+        offset = done % self.payload_size
+        count = min(conn.length - done, self.payload_size - offset)
+        conn.sent += conn.sock.send(buffer(self.payload, offset, count))
+
+    def close(self, conn):
+        fd = conn.sock.fileno()
+        if fd in self.conns:
+            del self.conns[fd]
+            self.poller.unregister(fd)
+        conn.sock.close()
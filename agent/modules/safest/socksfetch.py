@@ -0,0 +1,230 @@
+#
+# In-process HTTP fetches through a SOCKS4 proxy.
+#
+# A FetchLoop drives any number of non-blocking fetches from one poll()
+# loop, so a client node can keep many requests in flight without
+# forking curl for each one. Every Fetch records the same timings curl's
+# -w option reports (connect, time to first byte, total, bytes) and can
+# format them as the line the curl based agents used to log.
+#
+
+import errno
+import select
+import socket
+import struct
+import time
+
+CHUNK = 65536
+
+# Fetch states
+PROXY = 'proxy'        # connecting to the SOCKS proxy
+HANDSHAKE = 'socks'    # waiting for the proxy to open the tunnel
+REQUEST = 'request'    # sending the HTTP request
+RESPONSE = 'response'  # reading the reply
+DONE = 'done'
+
+
+class FetchError(Exception):
+    pass
+
+
+class Fetch(object):
+
+    def __init__(self, proxy, host, port, path, callback=None):
+        self.proxy = proxy
+        self.host = host
+        self.port = port
+        self.path = path
+        self.callback = callback
+        self.state = None
+        self.sock = None
+        self.outbuf = ''
+        self.inbuf = ''
+        self.started = None
+        self.connected = None
+        self.first_byte = None
+        self.finished = None
+        self.size = 0
+        self.length = None
+        self.status = None
+        self.error = None
+        self.headers_done = False
+
+    def start(self):
+        self.started = time.time()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex(self.proxy)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise FetchError("connect to proxy: %s" % errno.errorcode.get(err, err))
+        self.state = PROXY
+
+    def socks_request(self):
+        return struct.pack("!BBH", 4, 1, self.port) + socket.inet_aton(self.host) + "\0"
+
+    def http_request(self):
+        return ("GET %s HTTP/1.0\r\nHost: %s\r\nUser-Agent: safest\r\nConnection: close\r\n\r\n"
+                % (self.path, self.host))
+
+    def events(self):
+        if self.state in (PROXY, REQUEST) or self.outbuf:
+            return select.POLLOUT
+        return select.POLLIN
+
+    def writable(self):
+        if self.state == PROXY:
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise FetchError("connect to proxy: %s" % errno.errorcode.get(err, err))
+            self.outbuf = self.socks_request()
+            self.state = HANDSHAKE
+        sent = self.sock.send(self.outbuf)
+        self.outbuf = self.outbuf[sent:]
+        if not self.outbuf and self.state == REQUEST:
+            self.state = RESPONSE
+
+    def readable(self):
+        data = self.sock.recv(CHUNK)
+        if self.state == HANDSHAKE:
+            self.inbuf += data
+            if not data:
+                raise FetchError("proxy closed the connection")
+            if len(self.inbuf) < 8:
+                return
+            (version, code) = struct.unpack("!BB", self.inbuf[:2])
+            if code != 90:
+                raise FetchError("proxy refused the connection (%d)" % code)
+            self.connected = time.time()
+            self.inbuf = ''
+            self.outbuf = self.http_request()
+            self.state = REQUEST
+            return
+
+        if not data:
+            self.done()
+            return
+        if self.first_byte is None:
+            self.first_byte = time.time()
+        if self.headers_done:
+            self.size += len(data)
+        else:
+            self.inbuf += data
+            end = self.inbuf.find("\r\n\r\n")
+            if end < 0:
+                return
+            self.parse_headers(self.inbuf[:end])
+            self.size += len(self.inbuf) - end - 4
+            self.inbuf = ''
+            self.headers_done = True
+        if self.length is not None and self.size >= self.length:
+            self.done()
+
+    def parse_headers(self, head):
+        lines = head.split("\r\n")
+        try:
+            self.status = int(lines[0].split()[1])
+        except (IndexError, ValueError):
+            raise FetchError("bad status line %r" % lines[0])
+        for line in lines[1:]:
+            (name, sep, value) = line.partition(':')
+            if name.strip().lower() == 'content-length':
+                try:
+                    self.length = int(value)
+                except ValueError:
+                    pass
+
+    def done(self, error=None):
+        self.finished = time.time()
+        self.error = error
+        self.state = DONE
+        if self.sock is not None:
+            self.sock.close()
+
+    def elapsed(self, when):
+        if when is None:
+            return 0.0
+        return when - self.started
+
+    def line(self):
+        """The line curl -w used to log for this request"""
+        return "%d %.3f TTFB: %.3f Total time: %.3f Size: %d" % (
+            int(self.started), self.elapsed(self.connected), self.elapsed(self.first_byte),
+            self.elapsed(self.finished), self.size)
+
+
+class FetchLoop(object):
+    """Runs fetches concurrently from one poll() loop"""
+
+    def __init__(self, timeout=300):
+        self.timeout = timeout
+        self.poller = select.poll()
+        self.fetches = dict()
+
+    def add(self, fetch):
+        try:
+            fetch.start()
+        except (socket.error, FetchError) as e:
+            fetch.done(str(e))
+            self.complete(fetch)
+            return fetch
+        self.fetches[fetch.sock.fileno()] = fetch
+        self.poller.register(fetch.sock.fileno(), fetch.events())
+        return fetch
+
+    def pending(self):
+        return len(self.fetches)
+
+    def complete(self, fetch):
+        if fetch.callback is not None:
+            fetch.callback(fetch)
+
+    def finish(self, fd, fetch, error=None):
+        self.poller.unregister(fd)
+        del self.fetches[fd]
+        fetch.done(error)
+        self.complete(fetch)
+
+    def poll(self, wait=1.0):
+        """Make progress on every fetch, waiting at most wait seconds.
+           Returns the number of fetches still in flight."""
+        try:
+            ready = self.poller.poll(wait * 1000)
+        except select.error as e:
+            if e[0] != errno.EINTR:
+                raise
+            ready = []
+        for (fd, event) in ready:
+            fetch = self.fetches.get(fd)
+            if fetch is None:
+                continue
+            try:
+                if event & select.POLLOUT:
+                    fetch.writable()
+                elif event & (select.POLLIN | select.POLLHUP | select.POLLERR):
+                    fetch.readable()
+            except (socket.error, FetchError) as e:
+                self.finish(fd, fetch, str(e))
+                continue
+            if fetch.state == DONE:
+                self.poller.unregister(fd)
+                del self.fetches[fd]
+                self.complete(fetch)
+            else:
+                self.poller.modify(fd, fetch.events())
+
+        now = time.time()
+        for (fd, fetch) in self.fetches.items():
+            if now - fetch.started > self.timeout:
+                self.finish(fd, fetch, "timed out")
+        return len(self.fetches)
+
+    def run(self):
+        """Poll until every fetch has finished"""
+        while self.fetches:
+            self.poll()
+
+
+def parse_proxy(addr):
+    """'host:port' to a (ip, port) address"""
+    (host, port) = addr.rsplit(':', 1)
+    return (socket.gethostbyname(host), int(port))
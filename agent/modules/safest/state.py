@@ -0,0 +1,153 @@
+#
+# Crash-safe experiment state for ExperimentRunner.
+#
+# Everything the runner knows is written to a SQLite database as it
+# happens: the configured experiments, every run with the nodes it was
+# given, each phase transition with timestamps and each node's
+# acknowledgement of it. A restarted runner can find the runs that were
+# in flight when it died and tear them down or run them again.
+#
+
+import json
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS experiments (
+    name TEXT PRIMARY KEY,
+    config TEXT NOT NULL,
+    added REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    identity TEXT,
+    offsets TEXT,
+    status TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS phases (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run INTEGER NOT NULL REFERENCES runs(id),
+    phase TEXT NOT NULL,
+    status TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS acks (
+    run INTEGER NOT NULL REFERENCES runs(id),
+    phase TEXT NOT NULL,
+    node TEXT NOT NULL,
+    data TEXT,
+    received REAL NOT NULL,
+    PRIMARY KEY (run, phase, node)
+);
+"""
+
+RUNNING = 'running'
+COMPLETE = 'complete'
+FAILED = 'failed'
+ABORTED = 'aborted'
+
+
+class StateStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def execute(self, sql, args=()):
+        """Run one statement in its own transaction"""
+        self.lock.acquire()
+        try:
+            cur = self.db.execute(sql, args)
+            self.db.commit()
+            return cur
+        except Exception:
+            self.db.rollback()
+            raise
+        finally:
+            self.lock.release()
+
+    def query(self, sql, args=()):
+        self.lock.acquire()
+        try:
+            return self.db.execute(sql, args).fetchall()
+        finally:
+            self.lock.release()
+
+    # Experiments
+
+    def save_experiment(self, name, config):
+        self.execute("INSERT OR REPLACE INTO experiments (name, config, added) VALUES (?, ?, ?)",
+                     (name, json.dumps(config), time.time()))
+
+    def experiments(self):
+        """[(name, config)] in the order they were added"""
+        return [(row['name'], json.loads(row['config']))
+                for row in self.query("SELECT name, config FROM experiments ORDER BY added")]
+
+    # Runs
+
+    def start_run(self, name, identity=None, offsets=None):
+        cur = self.execute("INSERT INTO runs (name, identity, offsets, status, started) VALUES (?, ?, ?, ?, ?)",
+                           (name, identity, json.dumps(offsets or {}), RUNNING, time.time()))
+        return cur.lastrowid
+
+    def finish_run(self, run, status):
+        self.execute("UPDATE runs SET status = ?, finished = ? WHERE id = ?", (status, time.time(), run))
+        self.execute("UPDATE phases SET status = ?, finished = ? WHERE run = ? AND finished IS NULL",
+                     (status, time.time(), run))
+
+    def unfinished(self):
+        """Runs that were still going when the runner stopped"""
+        rows = self.query("SELECT * FROM runs WHERE status = ? ORDER BY id", (RUNNING,))
+        return [dict(row, offsets=json.loads(row['offsets'] or '{}')) for row in rows]
+
+    # Phases
+
+    def start_phase(self, run, phase):
+        self.execute("INSERT INTO phases (run, phase, status, started) VALUES (?, ?, ?, ?)",
+                     (run, phase, RUNNING, time.time()))
+
+    def finish_phase(self, run, phase, status=COMPLETE):
+        self.execute("UPDATE phases SET status = ?, finished = ? WHERE run = ? AND phase = ? AND finished IS NULL",
+                     (status, time.time(), run, phase))
+
+    def ack(self, run, phase, node, data=None):
+        self.execute("INSERT OR REPLACE INTO acks (run, phase, node, data, received) VALUES (?, ?, ?, ?, ?)",
+                     (run, phase, node, json.dumps(data), time.time()))
+
+    def acks(self, run, phase):
+        return [row['node'] for row in self.query("SELECT node FROM acks WHERE run = ? AND phase = ?", (run, phase))]
+
+    def current_phase(self, run):
+        rows = self.query("SELECT phase FROM phases WHERE run = ? ORDER BY id DESC LIMIT 1", (run,))
+        if rows:
+            return rows[0]['phase']
+        return None
+
+    def history(self, name=None):
+        """Per-phase (phase, runs, mean, min, max seconds) over finished
+           phases, optionally only for runs whose name starts with name"""
+        sql = ("SELECT p.phase AS phase, COUNT(*) AS n, AVG(p.finished - p.started) AS mean, "
+               "MIN(p.finished - p.started) AS shortest, MAX(p.finished - p.started) AS longest, "
+               "MIN(p.id) AS first "
+               "FROM phases p JOIN runs r ON p.run = r.id "
+               "WHERE p.status = ? AND p.finished IS NOT NULL")
+        args = [COMPLETE]
+        if name:
+            sql += " AND r.name LIKE ?"
+            args.append("%s%%" % name)
+        sql += " GROUP BY p.phase ORDER BY first"
+        return [(row['phase'], row['n'], row['mean'], row['shortest'], row['longest'])
+                for row in self.query(sql, args)]
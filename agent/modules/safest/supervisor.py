@@ -0,0 +1,182 @@
+#
+# Supervision of a single tor process.
+#
+# Keeps hold of the real tor process (not a sudo wrapper), reaps it,
+# waits for it to bootstrap instead of sleeping for a fixed time, and
+# stops it with SIGTERM before escalating to SIGKILL.
+#
+
+from subprocess import Popen
+import os
+import re
+import signal
+import time
+
+BOOTSTRAP_RE = re.compile(r"Bootstrapped (\d+)%")
+
+
+class SupervisorError(Exception):
+    pass
+
+
+class TorProcess(object):
+
+    def __init__(self, tor_bin, torrc, log, env=None):
+        self.tor_bin = tor_bin
+        self.torrc = torrc
+        self.log = log
+        self.env = env or []
+        self.proc = None
+
+    def command(self):
+        cmd = [self.tor_bin, "-f", self.torrc]
+        if os.getuid() != 0:
+            # sudo would hide the real tor pid from us, so only use it
+            # when we have to.
+            return ['sudo'] + list(self.env) + cmd
+        return cmd
+
+    def environment(self):
+        env = dict(os.environ)
+        for var in self.env:
+            (name, value) = var.split('=', 1)
+            env[name] = value
+        return env
+
+    def start(self):
+        if self.is_alive():
+            raise SupervisorError("tor is already running as %s" % self.pid())
+        cmd = self.command()
+        self.log.info("Starting Tor with command: %s" % cmd)
+        self.proc = Popen(cmd, env=self.environment(), close_fds=True)
+        self.started = time.time()
+        return self.proc.pid
+
+    def pid(self):
+        if self.proc is None:
+            return None
+        return self.proc.pid
+
+    def is_alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def signal(self, sig):
+        if not self.is_alive():
+            raise SupervisorError("tor is not running")
+        os.kill(self.proc.pid, sig)
+
+    def stop(self, timeout=10):
+        """SIGTERM tor, wait up to timeout seconds for it to exit, then SIGKILL"""
+        if self.proc is None:
+            return None
+        if self.is_alive():
+            if timeout > 0:
+                os.kill(self.proc.pid, signal.SIGTERM)
+                if wait_exit(self.proc, timeout):
+                    return self.proc.returncode
+                self.log.warning("Tor (%s) ignored SIGTERM for %s seconds, killing it" % (self.proc.pid, timeout))
+            try:
+                os.kill(self.proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        self.proc.wait()
+        return self.proc.returncode
+
+    def wait_ready(self, progress, target=100, timeout=300):
+        """Poll progress() until it reaches target. progress returns the
+           bootstrap percentage, or None if it can't tell yet. Returns the
+           last progress seen, raises if tor dies while we wait."""
+        deadline = time.time() + timeout
+        last = None
+        while True:
+            if not self.is_alive():
+                raise SupervisorError("tor exited with %s while bootstrapping" % self.proc.returncode)
+            current = progress()
+            if current is not None:
+                if current != last:
+                    self.log.info("Tor bootstrapped %d%%" % current)
+                last = current
+                if current >= target:
+                    return last
+            if time.time() > deadline:
+                return last
+            time.sleep(0.5)
+
+
+class LogProgress(object):
+    """Follows a tor log for 'Bootstrapped N%' notices written after it
+       was created"""
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.progress = None
+        if os.path.exists(path):
+            self.offset = os.path.getsize(path)
+
+    def __call__(self):
+        try:
+            f = open(self.path)
+        except IOError:
+            return self.progress
+        try:
+            f.seek(0, 2)
+            if f.tell() < self.offset:
+                self.offset = 0
+            f.seek(self.offset)
+            data = f.read()
+            self.offset = f.tell()
+        finally:
+            f.close()
+        for match in BOOTSTRAP_RE.finditer(data):
+            self.progress = int(match.group(1))
+        return self.progress
+
+
+def wait_exit(proc, timeout):
+    deadline = time.time() + timeout
+    while proc.poll() is None:
+        if time.time() > deadline:
+            return False
+        time.sleep(0.1)
+    return True
+
+
+def find_processes(name):
+    """Pids of processes whose command name is name"""
+    pids = list()
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            stat = open('/proc/%s/stat' % entry).read()
+        except IOError:
+            continue
+        if stat[stat.find('(') + 1:stat.rfind(')')] == name:
+            pids.append(int(entry))
+    return pids
+
+
+def kill_strays(name, log, exclude=(), timeout=5):
+    """Stop processes called name that we don't supervise (e.g. one started
+       by the package's init script), escalating to SIGKILL"""
+    pids = [pid for pid in find_processes(name) if pid not in exclude]
+    if not pids:
+        return
+    log.info("Stopping stray %s processes %s" % (name, pids))
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        pids = [pid for pid in pids if os.path.exists('/proc/%d' % pid)]
+        if not pids:
+            return
+        time.sleep(0.1)
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
@@ -0,0 +1,76 @@
+#
+# Cached torrc templates and atomic config writes.
+#
+# Templates are read and compiled once per agent, and only re-read when
+# their mtime or size changes (and only recompiled when their content
+# actually differs). Rendered configs are written with a rename, and not
+# at all when they match what is already on disk.
+#
+
+from string import Template
+import hashlib
+import os
+
+
+class TemplateCache(object):
+
+    def __init__(self, log):
+        self.log = log
+        self.entries = dict()
+
+    def load(self, path):
+        """Return (text, Template) for path, re-reading it only if it changed"""
+        st = os.stat(path)
+        stamp = (st.st_mtime, st.st_size)
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == stamp:
+            return (entry[2], entry[3])
+
+        text = open(path).read()
+        digest = hashlib.sha1(text).hexdigest()
+        if entry is not None and entry[1] == digest:
+            template = entry[3]
+        else:
+            self.log.info("Compiling template %s" % path)
+            template = Template(text)
+        self.entries[path] = (stamp, digest, text, template)
+        return (text, template)
+
+    def read(self, path):
+        return self.load(path)[0]
+
+    def render(self, path, vars):
+        return self.load(path)[1].substitute(vars)
+
+    def digest(self, path):
+        self.load(path)
+        return self.entries[path][1]
+
+
+def write_if_changed(destination, text):
+    """Atomically replace destination with text. Returns False (and
+       doesn't write) if destination already holds exactly text."""
+    try:
+        f = open(destination)
+        try:
+            if f.read() == text:
+                return False
+        finally:
+            f.close()
+    except IOError:
+        pass
+
+    dest_path = os.path.dirname(destination)
+    if not os.path.exists(dest_path):
+        os.makedirs(dest_path)
+
+    tmp = "%s.%s.tmp" % (destination, os.getpid())
+    f = open(tmp, 'w')
+    try:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(tmp, destination)
+    return True
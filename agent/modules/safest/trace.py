@@ -0,0 +1,99 @@
+#
+# Streaming trace replay for the traffic agents.
+#
+# A trace is a text file of records, one per line:
+#
+#     <offset seconds> <destination> <size or command>
+#
+# sorted by offset. Blank lines and lines starting with '#' are skipped.
+# Records are read one at a time, so traces can be much larger than
+# memory, and each is issued when its offset comes due. How late each
+# record was issued against the schedule is tracked and summarised.
+#
+
+import time
+
+
+class TraceError(Exception):
+    pass
+
+
+def records(path):
+    """Yield (offset, destination, argument) for each record in path"""
+    f = open(path)
+    try:
+        lineno = 0
+        for line in f:
+            lineno += 1
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                (offset, dst, arg) = line.split(None, 2)
+                yield (float(offset), dst, arg)
+            except ValueError:
+                raise TraceError("%s:%d: expected '<offset> <destination> <size or command>'" % (path, lineno))
+    finally:
+        f.close()
+
+
+def destinations(path):
+    """The distinct destinations in the trace at path"""
+    return set([dst for (offset, dst, arg) in records(path)])
+
+
+class LagStats(object):
+
+    LATE = 1.0
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.worst = 0.0
+        self.late = 0
+
+    def add(self, lag):
+        self.count += 1
+        self.total += lag
+        self.worst = max(self.worst, lag)
+        if lag > self.LATE:
+            self.late += 1
+
+    def __str__(self):
+        mean = self.total / self.count if self.count else 0.0
+        return ("%d records issued, lag mean %.3fs max %.3fs, %d more than %.0fs late"
+                % (self.count, mean, self.worst, self.late, self.LATE))
+
+
+class Replayer(object):
+    """Calls issue(record) for each record of the trace at path when it
+       comes due. wait(seconds) should block for at most that long (and
+       may do useful work meanwhile, e.g. poll a FetchLoop)."""
+
+    SUMMARY_INTERVAL = 60
+
+    def __init__(self, path, issue, wait=time.sleep, log=None):
+        self.path = path
+        self.issue = issue
+        self.wait = wait
+        self.log = log
+        self.lag = LagStats()
+
+    def run(self, start=None):
+        if start is None:
+            start = time.time()
+        summary = time.time() + self.SUMMARY_INTERVAL
+        for record in records(self.path):
+            due = start + record[0]
+            now = time.time()
+            while now < due:
+                self.wait(min(due - now, 1.0))
+                now = time.time()
+            self.lag.add(now - due)
+            self.issue(record)
+            if self.log is not None and now >= summary:
+                self.log.info("Replaying %s: %s" % (self.path, self.lag))
+                summary = now + self.SUMMARY_INTERVAL
+        if self.log is not None:
+            self.log.info("Finished replaying %s: %s" % (self.path, self.lag))
+        return self.lag
@@ -0,0 +1,261 @@
+#
+# Workload scheduling for the traffic agents.
+#
+# Drives in-process fetches (see socksfetch.py) for many simulated Tor
+# users from a single traffic controller process.
+#
+# Every request a node will make is decided up front from a seed: a
+# Schedule holds the gap before each request, its size and its
+# destination in compact typed arrays, so the loops below only walk
+# arrays and the same seed reproduces the same requests. Schedules are
+# saved next to the agent's logs so they go out with the results. A
+# schedule holds at most MAX_ENTRIES requests, so a near zero think time
+# or a high arrival rate can't fill memory; one that hits the cap ends
+# before duration and is marked truncated.
+#
+
+from array import array
+import hashlib
+import json
+import random
+import time
+
+# 18 bytes an entry on 64 bit ('d', 'L' and 'H' arrays)
+MAX_ENTRIES = 1000000
+
+
+def draw(dist):
+    """One sample from a DistVar value (or a plain number)"""
+    if hasattr(dist, 'getValue'):
+        return dist.getValue()
+    if callable(dist):
+        return dist()
+    return float(dist)
+
+
+def node_seed(base, node, user=0):
+    """Seed for one user on one node, derived from the experiment's seed"""
+    return int(hashlib.sha1("%s/%s/%d" % (base, node, user)).hexdigest()[:15], 16)
+
+
+class Schedule(object):
+    """gaps[i] seconds before request i of sizes[i] bytes to hosts[dests[i]].
+       For a closed loop the gap is the think time after the previous
+       request finished, for an open loop the time since the previous
+       arrival."""
+
+    def __init__(self, seed, hosts, gaps=None, sizes=None, dests=None):
+        self.seed = seed
+        self.hosts = list(hosts)
+        self.gaps = gaps or array('d')
+        self.sizes = sizes or array('L')
+        self.dests = dests or array('H')
+        self.truncated = False
+
+    def __len__(self):
+        return len(self.gaps)
+
+    def append(self, gap, size, dest):
+        self.gaps.append(gap)
+        self.sizes.append(int(size))
+        self.dests.append(dest)
+
+    def entry(self, i):
+        return (self.gaps[i], self.sizes[i], self.hosts[self.dests[i]])
+
+    def save(self, path):
+        """One JSON header line followed by the raw arrays"""
+        f = open(path, 'wb')
+        try:
+            header = {'seed': self.seed, 'hosts': self.hosts, 'count': len(self), 'truncated': self.truncated,
+                      'types': [self.gaps.typecode, self.sizes.typecode, self.dests.typecode]}
+            f.write("%s\n" % json.dumps(header))
+            for a in (self.gaps, self.sizes, self.dests):
+                a.tofile(f)
+        finally:
+            f.close()
+
+    @classmethod
+    def load(cls, path):
+        f = open(path, 'rb')
+        try:
+            header = json.loads(f.readline())
+            arrays = list()
+            for typecode in header['types']:
+                a = array(str(typecode))
+                a.fromfile(f, header['count'])
+                arrays.append(a)
+        finally:
+            f.close()
+        schedule = cls(header['seed'], header['hosts'], *arrays)
+        schedule.truncated = header.get('truncated', False)
+        return schedule
+
+
+def seeded(seed):
+    """Seed the global generator (which the DistVar distributions draw from)
+       and return a private one for everything else"""
+    random.seed(seed)
+    return random.Random(seed)
+
+
+def closed_schedule(seed, think, sizes, hosts, duration, limit=MAX_ENTRIES):
+    """Think times, sizes and destinations for a user that could keep
+       going for duration seconds if every request were instant, up to
+       limit requests"""
+    rng = seeded(seed)
+    schedule = Schedule(seed, hosts)
+    elapsed = 0.0
+    while elapsed < duration:
+        if len(schedule) >= limit:
+            schedule.truncated = True
+            break
+        gap = float(draw(think))
+        schedule.append(gap, draw(sizes), rng.randrange(len(hosts)))
+        elapsed += max(gap, 0.001)
+    return schedule
+
+
+def open_schedule(seed, rate, sizes, hosts, duration, limit=MAX_ENTRIES):
+    """Poisson arrivals of rate per second over duration seconds, up to
+       limit arrivals"""
+    rng = seeded(seed)
+    schedule = Schedule(seed, hosts)
+    elapsed = 0.0
+    while True:
+        gap = rng.expovariate(rate)
+        elapsed += gap
+        if elapsed > duration:
+            return schedule
+        if len(schedule) >= limit:
+            schedule.truncated = True
+            return schedule
+        schedule.append(gap, draw(sizes), rng.randrange(len(hosts)))
+
+
+class User(object):
+
+    def __init__(self, ident, schedule):
+        self.ident = ident
+        self.schedule = schedule
+        self.next = 0
+        self.due = 0
+        self.busy = False
+
+    def finished(self):
+        return self.next >= len(self.schedule)
+
+
+class ClosedLoop(object):
+    """Independent virtual users, one per schedule, that each fetch, think
+       and fetch again, with at most max_concurrent fetches in flight on
+       the node"""
+
+    def __init__(self, loop, schedules, start_fetch, max_concurrent=None, done=None):
+        self.loop = loop
+        self.users = [User(i, schedules[i]) for i in xrange(len(schedules))]
+        self.start_fetch = start_fetch
+        self.max_concurrent = max_concurrent or len(self.users)
+        self.done = done
+
+    def run(self, until=None):
+        now = time.time()
+        for user in self.users:
+            if not user.finished():
+                user.due = now + user.schedule.gaps[0]
+        while until is None or time.time() < until:
+            if self.loop.pending() == 0 and not [u for u in self.users if not u.finished()]:
+                break
+            self.dispatch()
+            self.loop.poll(self.wait())
+
+    def dispatch(self):
+        now = time.time()
+        idle = [u for u in self.users if not u.busy and not u.finished() and u.due <= now]
+        idle.sort(key=lambda user: user.due)
+        for user in idle:
+            if self.loop.pending() >= self.max_concurrent:
+                break
+            (gap, size, host) = user.schedule.entry(user.next)
+            user.next += 1
+            user.busy = True
+            fetch = self.start_fetch(host, size)
+            fetch.callback = lambda fetch, user=user: self.finished(user, fetch)
+            self.loop.add(fetch)
+
+    def finished(self, user, fetch):
+        user.busy = False
+        if not user.finished():
+            user.due = time.time() + user.schedule.gaps[user.next]
+        if self.done is not None:
+            self.done(fetch)
+
+    def wait(self):
+        """How long the next poll may block"""
+        if self.loop.pending() >= self.max_concurrent:
+            return 1.0
+        due = [u.due for u in self.users if not u.busy and not u.finished()]
+        if not due:
+            return 1.0
+        return max(0, min(min(due) - time.time(), 1.0))
+
+
+class OpenLoop(object):
+    """Starts the fetches of an open_schedule at their arrival times,
+       whether or not earlier ones have finished. Arrivals that find
+       max_outstanding fetches in flight are dropped and counted."""
+
+    SUMMARY_INTERVAL = 60
+
+    def __init__(self, loop, schedule, start_fetch, max_outstanding,
+                 done=None, dropped=None, log=None):
+        self.loop = loop
+        self.schedule = schedule
+        self.start_fetch = start_fetch
+        self.max_outstanding = max_outstanding
+        self.done = done
+        self.on_drop = dropped
+        self.log = log
+        self.offered = 0
+        self.dropped = 0
+        self.completed = 0
+
+    def run(self, until=None):
+        now = time.time()
+        arrival = now
+        summary = now + self.SUMMARY_INTERVAL
+        for i in xrange(len(self.schedule)):
+            (gap, size, host) = self.schedule.entry(i)
+            arrival += gap
+            while now < arrival:
+                if until is not None and now >= until:
+                    return
+                if self.log is not None and now >= summary:
+                    self.summarize()
+                    summary = now + self.SUMMARY_INTERVAL
+                self.loop.poll(max(0, min(arrival - now, 1.0)))
+                now = time.time()
+            self.arrive(arrival, host, size)
+        self.loop.run()
+        if self.log is not None:
+            self.summarize()
+
+    def arrive(self, when, host, size):
+        self.offered += 1
+        if self.loop.pending() >= self.max_outstanding:
+            self.dropped += 1
+            if self.on_drop is not None:
+                self.on_drop(when, self.loop.pending())
+            return
+        fetch = self.start_fetch(host, size)
+        fetch.callback = self.finished
+        self.loop.add(fetch)
+
+    def finished(self, fetch):
+        self.completed += 1
+        if self.done is not None:
+            self.done(fetch)
+
+    def summarize(self):
+        self.log.info("Open loop: %d offered, %d completed, %d dropped, %d outstanding"
+                      % (self.offered, self.completed, self.dropped, self.loop.pending()))
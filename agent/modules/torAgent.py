@@ -32,19 +32,34 @@ from backend.agent import Agent
 from backend.variables import *
 from backend.addon import services
 from testbed import testbed
-from string import Template
-import apt
 import os
-from subprocess import Popen, call
+from subprocess import Popen
 import subprocess
+import signal
+import threading
 import time
 from calendar import timegm
 import shutil
 import re
 import sys
-import pexpect
 import socket,struct
 
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from safest import rendezvous
+from safest import keystore
+from safest import deploy
+from safest import provision
+from safest import torrc
+from safest import control
+from safest import collector
+from safest import archive
+from safest import shipper
+from safest import fsreset
+from safest import supervisor
+from safest import bundle
+
+provision.require('tor', 'tsocks', 'libgmp3-dev')
+
 class TorAgent(Agent):
     """ Tor Agent to setup a Tor net on an experiment """
     
@@ -54,29 +69,46 @@ class TorAgent(Agent):
     AGENTGROUP = 'Configuration'
     AGENTTYPE = 'TOR'
     NICENAME = 'Tor'
-    COMMANDS = ['START', 'STOP','KILL','HUP',"SEND_CTRL_MSG","RM_CACHE","SAVE_DATA"]
+    COMMANDS = ['START', 'STOP','KILL','HUP',"SEND_CTRL_MSG","RM_CACHE","SAVE_DATA","GEN_KEYS","QUERY_CTRL","APPLY"]
     VARIABLES = [
         #IntVar('directory_count', None, 'DirectoryCount', 'Number of directories'),
         NodeListVar('directory', None, 'Directory', 'Select the nodes that will be the Tor Directory'),
         NodeListVar('relays', None, 'Relays', 'Select the nodes that will be the Tor Relays'),
         NodeListVar('clients', None, 'Client', 'Select the node that will be the client'),
+        StringVar('run_tag', None, 'Run Tag', 'Name of this Tor network when several run in one experiment; namespaces the directory files and results'),
+        IntVar('pools', 1, 'Parallel Pools', 'Number of Tor networks running side by side; KILL only stops tor processes it did not start when this is 1'),
         StringVar('template_dir', None, 'TemplateDir', 'Directory for Tor template'),
         StringVar('tor_binary', None, 'Tor Binary', 'The path of a modified Tor binary to use'),
+        IntVar('ready_timeout',None,"Ready Timeout","Seconds START waits for Tor to bootstrap (default 300)"),
         StringListVar('env_var_export',None,"Environment Variables","Comma separated list of environment variables to export 'VAR=blahblahblah'"),
         StringVar('save_data_dir',None,"Save Directory", "The path to save logs to if requested"),
+        StringListVar('pkg_cache',None,"Package Cache", "Comma separated list of directories holding .deb files to install from before falling back to apt"),
+        StringVar('key_store',None,"Key Store", "Directory to cache directory authority keys in (default /proj/<project>/tor-keys)"),
         StringListVar('client_config_list',None,"Client Config","Comma separated list of Tor configuration options "),
         StringListVar('relay_config_list',None,"Relay Config","Comma separated list of Tor configuration options for relays"),
+        Title("Data Collection"),
+        StringVar('save_mode','archive',"Save Mode","'archive' streams one compressed tarball per node, 'copy' copies files one by one"),
+        StringListVar('save_include',None,"Save Include","Comma separated list of glob patterns of files to save (default everything)"),
+        StringListVar('save_exclude',None,"Save Exclude","Comma separated list of glob patterns of files not to save"),
+        IntVar('save_stagger',0,"Save Stagger","Spread node uploads evenly over this many seconds"),
+        IntVar('save_rate',0,"Save Rate","Limit each node's upload to this many bytes per second (0 for no limit)"),
+        IntVar('ship_interval',0,"Ship Interval","Ship new log data to the save directory every this many seconds during a run (0 to disable)"),
+        StringListVar('ship_tail',None,"Ship Logs","Comma separated list of globs of log files to ship incrementally (default the tor log and *.log in the data directory)"),
+        StringListVar('ship_snapshot',None,"Ship State","Comma separated list of globs of state files to ship whole whenever they change"),
         Title("Control Port Messaging"),
         NodeListVar('ctl_dst', None, 'Control Targets','The nodes to send control messages to'),
-        StringVar("ctl_msg",None,'Control Port Message','The command to send to the control port. You will not see the response, so be don\' send GETINFO or similar')
+        StringVar("ctl_msg",None,'Control Port Message','The command(s) to send to the control port, separated by \';\'. SEND_CTRL_MSG only logs responses on the node; use QUERY_CTRL to collect them'),
+        StringVar("collector",None,'Collector','host:port of the ExperimentRunner collector that QUERY_CTRL responses are sent to'),
+        StringVar("bundle",None,'Variable Bundle','JSON bundle of variable values, applied in one step before each command (see safest/bundle.py)')
         ]
 
     DATA_DIR = "/var/lib/tor"
-    TOR_GENCERT="/usr/bin/tor-gencert"
     TOR_BIN="/usr/sbin/tor"
     TOR_RC="/etc/tor/torrc"
     CONTROL_DIR="/var/run/tor"
     TOR_LOG='/var/log/tor/log'
+    STOP_TIMEOUT=10
+    READY_TIMEOUT=300
     TOR_CACHE={'files':[
                     'cached-certs',
                     'log',
@@ -101,8 +133,24 @@ class TorAgent(Agent):
         Agent.__init__(self)
 
         self.beenSetup = False
-        self.tor_pid = None
+        self.tor = None
+        self.bootstrap_log = None
+        self.watcher = None
+        self.watcher_stop = None
+        self.rendezvous = None
+        self.deploy_result = None
+        self.templates = torrc.TemplateCache(self.log)
+        self.control_port = None
+        self.shipper = None
+        self.save_path = None
+        self.set_dirline_paths()
+
+    def set_dirline_paths(self):
+        """Directory line exchange files, namespaced by run_tag so several
+           Tor networks can share an experiment"""
         directorylinedir = "/proj/%s/exp/%s" % (testbed.project, testbed.experiment)
+        if self.run_tag:
+            directorylinedir = "%s/%s" % (directorylinedir, self.run_tag)
         self.dirline_file = "%s/dirfile" % directorylinedir
         self.dirline_lock = "%s/dirlock" % directorylinedir
         self.dirline_sem = "%s/dirsem" %directorylinedir
@@ -123,75 +171,54 @@ class TorAgent(Agent):
         return "0.0.0.0"
     
     def write_config(self, template_file, destination, **vars):
-        """Write out the tor rc file"""
+        """Write out the tor rc file. Returns True if its contents changed"""
 
-        self.log.info("Writing tor rc file")
-        
         template_file = "%s/%s" % (self.template_dir, template_file)
-        
-        self.log.info("Opening template file %s." % template_file)
+
         try:
-            template = Template(open(template_file).read())
+            config = self.templates.render(template_file, vars)
         except Exception as e:
             self.log.info("Failed reading template file %s: %s" % (template_file, str(e)))
             sys.exit(1)
-            
-        config = template.substitute(vars)
-
-        self.log.info("Checking that destination directory exists")
-        dest_path = os.path.dirname(destination)
 
-        if not os.path.exists(dest_path):
-            os.makedirs(dest_path)
-            
-        self.log.info("Writing tor rc file to %s" % destination)
         try:
-            rc = open(destination, "w")
-            rc.write(config)
+            changed = torrc.write_if_changed(destination, config)
         except Exception as e:
             self.log.info("Failed to write tor rc file %s: %s" %(template_file, str(e)))
             self.log.info("Is tor installed (use -i)?")
             sys.exit(1)
 
+        if destination == self.TOR_RC:
+            self.control_port = control.find_control_port(config)
 
-    def install_packages(self, names):
-        """Use python-apt to install a list of packages, such as tor"""
-        # THIS ONLY WORKS ON UBUNTU
-        
-        self.log.info("Install packages")
-        
-        cache = apt.Cache()
-        
-        self.log.info("Updating apt cache")
-
-        try:
-            cache.update()
-        except Exception as e:
-            self.log.info("Failed to update the apt cache: %s" % str(e))
-            self.log.info("Are you running as root?")
-
-        cache.open(None)
-
-        self.log.info("Marking packages")
+        if changed:
+            self.log.info("Wrote tor rc file %s from %s" % (destination, template_file))
+        else:
+            self.log.info("Tor rc file %s unchanged" % destination)
+        return changed
 
-        for name in names:
+    def control_connection(self):
+        """The pooled control port connection to our tor, or None if it has no ControlPort"""
+        if self.control_port is None:
             try:
-                pkg = cache[name]
-                
-                if not pkg.is_installed:
-                    self.log.info("Marking %s for installation" % name)
-                    pkg.mark_install()
-
-            except Exception as e:
-                self.log.info("Problem looking up or marking %s for installation: %s" % (name, str(e)))
-
-        self.log.info("Installing packages...")
-
-        try:
-            cache.commit()
-        except Exception as e:
-            self.log.info("Failed to install packages: %s" % str(e))
-            self.log.info("Are you running as root?")
+                self.control_port = control.find_control_port(open(self.TOR_RC).read())
+            except IOError:
+                return None
+        (addr, port) = self.control_port
+        if port is None:
+            return None
+        return control.get(addr, port)
+
+    def control_batch(self, commands):
+        """Pipeline commands to our tor's control port, returning the replies"""
+        conn = self.control_connection()
+        if conn is None:
+            raise control.ControlError("%s is not running a control port" % testbed.getNodeName())
+        return conn.batch(commands)
+
+    def close_control(self):
+        if self.control_port is not None and self.control_port[1] is not None:
+            control.discard(*self.control_port)
 
     def simple_run(self, cmd, die=True):
         """Basic function to run a command and log it"""
@@ -213,45 +240,164 @@ class TorAgent(Agent):
         return command_output
 
     def isRunning(self):
-        try:
-            if self.tor_pid:
-                return True
-        except Exception:
-            pass
-        return False
+        return self.tor is not None and self.tor.is_alive()
 
     def start_tor(self):
         self.log.info("Starting Tor")
-        if self.env_var_export is not None and len(self.env_var_export) > 0:
-            cmd = ['sudo']
-            cmd.extend(self.env_var_export)
-            cmd.extend([self.TOR_BIN,"-f",self.TOR_RC])
-        else:
-            cmd = ['sudo',self.TOR_BIN,"-f",self.TOR_RC]
-        self.log.info("Starting Tor with command: %s [pid: %s]" % (cmd,self.tor_pid))
-        self.tor_pid = Popen(cmd).pid 
-
-    def stop_tor(self,force=False):
-        if force:
-            call(['sudo','killall','-9','tor'])
-            self.tor_pid = None
-        elif self.isRunning():
+        self.tor = supervisor.TorProcess(self.TOR_BIN, self.TOR_RC, self.log, self.env_var_export)
+        self.bootstrap_log = supervisor.LogProgress(self.TOR_LOG)
+        pid = self.tor.start()
+        self.log.info("Started Tor [pid: %s]" % pid)
+
+    def stop_tor(self,force=False,strays=True):
+        """Stop our tor with SIGTERM, escalating to SIGKILL if it doesn't exit.
+           force kills it right away, along with any tor we didn't start
+           (e.g. the package's init script tor) unless strays is False"""
+        self.stop_watcher()
+        self.close_control()
+        if self.isRunning():
             self.log.info("Stopping Tor")
-            try:
-                self.simple_run('sudo kill %s' % (self.tor_pid),die=False)
-            except CalledProcessError:
-                self.log.error("Force-killing Tor")
-                self.stop_tor(force=True)
-            self.tor_pid = None
-        else:
+            if force:
+                code = self.tor.stop(timeout=0)
+            else:
+                code = self.tor.stop(timeout=self.STOP_TIMEOUT)
+            self.log.info("Tor exited with %s" % code)
+        elif not force:
             self.log.info("Tor not running; not stopped")
+        self.tor = None
+
+        if force and strays:
+            supervisor.kill_strays('tor', self.log, timeout=0)
 
     def restart_tor(self):
         self.stop_tor()
-        time.sleep(2)
         self.start_tor()
 
+    def bootstrap_progress(self):
+        """Tor's bootstrap percentage, from the control port if it's up and
+           from the log otherwise. None if we can't tell yet"""
+        try:
+            reply = self.control_batch(['GETINFO status/bootstrap-phase'])[0]
+            match = re.search(r"PROGRESS=(\d+)", str(reply))
+            if reply.ok() and match:
+                return int(match.group(1))
+        except Exception:
+            pass
+        return self.bootstrap_log()
+
+    def wait_until_ready(self, target):
+        """Block until tor has bootstrapped to target percent (0 just means
+           it is up), for at most ready_timeout seconds. Reports 'ready' to
+           the collector once it gets there, keeping watch in the background
+           if that takes longer than ready_timeout"""
+        started = time.time()
+        timeout = self.ready_timeout or self.READY_TIMEOUT
+        progress = self.tor.wait_ready(self.bootstrap_progress, target, timeout)
+        if progress is None or progress < target:
+            self.log.warning("Tor not ready after %d seconds (bootstrapped %s%%), still watching" % (timeout, progress))
+            self.stop_watcher()
+            self.watcher_stop = threading.Event()
+            self.watcher = threading.Thread(target=self.watch_ready,
+                                            args=(self.tor, target, started, self.watcher_stop))
+            self.watcher.setDaemon(True)
+            self.watcher.start()
+        else:
+            self.log.info("Tor ready in %.1f seconds" % (time.time() - started))
+            self.report('ready', {'progress': progress, 'seconds': time.time() - started})
+        return progress
+
+    def watch_ready(self, tor, target, started, stop):
+        """Report 'ready' once tor reaches target, however long it takes.
+           Gives up when tor exits or stop is set"""
+        try:
+            while not stop.isSet():
+                progress = tor.wait_ready(self.bootstrap_progress, target, 1)
+                if progress is not None and progress >= target:
+                    self.log.info("Tor ready in %.1f seconds" % (time.time() - started))
+                    self.report('ready', {'progress': progress, 'seconds': time.time() - started})
+                    return
+        except supervisor.SupervisorError as e:
+            self.log.info("Stopped waiting for Tor to bootstrap: %s" % e)
+
+    def stop_watcher(self):
+        """Stop watching a slow bootstrap in the background"""
+        if self.watcher is None:
+            return
+        self.watcher_stop.set()
+        self.watcher.join()
+        self.watcher = None
+
+    def tor_nodes(self):
+        """Every node in the Tor network"""
+        nodes = set()
+        for group in (self.directory, self.relays, self.clients):
+            if group:
+                nodes.update(list(group))
+        return nodes
+
+    def in_network(self):
+        """Whether this node is part of our Tor network. Group commands reach
+           every node, including ones another network is running on"""
+        return testbed.nodename in self.tor_nodes()
+
+    def rendezvous_host(self):
+        """The directory authority that runs the directory line rendezvous"""
+        names = list(self.directory)
+        names.sort()
+        return names[0]
+
+    def rendezvous_address(self):
+        return testbed.getIPForNode(self.rendezvous_host())[0]
+
+    def start_rendezvous(self):
+        """Start the rendezvous service if we're the node that hosts it"""
+        self.stop_rendezvous()
+        if testbed.nodename != self.rendezvous_host():
+            return
+
+        try:
+            self.rendezvous = rendezvous.RendezvousServer(len(self.directory), len(self.tor_nodes()),
+                                                          self.log, fallback_file=self.dirline_file,
+                                                          fallback_sem=self.dirline_sem,
+                                                          fallback_lock=self.new_dirline_mutex())
+            self.rendezvous.start()
+        except socket.error as e:
+            self.log.warning("Failed to start directory rendezvous, nodes will use %s: %s" % (self.dirline_file, e))
+            self.rendezvous = None
+
+    def stop_rendezvous(self):
+        if self.rendezvous is None:
+            return
+        settle = self.rendezvous.settle_time()
+        if settle is not None:
+            self.log.info("Directory rendezvous settled in %.2f seconds" % settle)
+        else:
+            self.log.info("Directory rendezvous never released every subscriber")
+        self.rendezvous.stop()
+        self.rendezvous = None
+
+    def new_dirline_mutex(self):
+        """An NFS safe lock on the directory line file"""
+        try:
+            import flufl.lock
+        except ImportError:
+            sys.path.append("/opt/local/egg/flufl-lock.egg")
+            import flufl.lock
+        return flufl.lock.Lock(self.dirline_lock)
+
     def get_directory_line(self):
+        self.log.info("Waiting on directory rendezvous at %s" % self.rendezvous_host())
+        try:
+            started = time.time()
+            dirline = rendezvous.wait(self.rendezvous_address(), testbed.nodename)
+            self.log.info("Got Dirline from rendezvous after %.2f seconds" % (time.time() - started))
+            return dirline
+        except Exception as e:
+            self.log.warning("Directory rendezvous failed, falling back to %s: %s" % (self.dirline_file, e))
+
+        return self.get_directory_line_file()
+
+    def get_directory_line_file(self):
         self.log.info("Spin-waiting for directory file")
         attempts = 0
         while (os.path.exists(self.dirline_sem) or not os.path.exists(self.dirline_file)):
@@ -269,6 +415,12 @@ class TorAgent(Agent):
         self.log.info("Got Dirline")
         return dirline
 
+    def get_key_store(self):
+        root = self.key_store
+        if not root:
+            root = "/proj/%s/tor-keys" % testbed.project
+        return keystore.KeyStore(root, self.log)
+
     def remove_if_exists(self,f):
         try:
             os.remove(f)
@@ -281,64 +433,55 @@ class TorAgent(Agent):
     def setup(self):
         """ Setup our nodes with Tor """
         #HACK UP DIRECTORY FILE
-        directorylinedir = "/proj/%s/exp/%s" % (testbed.project, testbed.experiment)
-        self.dirline_file = "%s/dirfile" % directorylinedir
-        self.dirline_lock = "%s/dirlock" % directorylinedir
-        self.dirline_sem = "%s/dirsem" %directorylinedir
-        self.remove_if_exists(self.dirline_file)
-        self.remove_if_exists(self.dirline_lock)
-        self.remove_if_exists(self.dirline_sem)
+        self.set_dirline_paths()
+        try:
+            os.makedirs(os.path.dirname(self.dirline_file))
+        except OSError:
+            pass
 
-        
         self.log.info("In Setup")
 
-        self.install_packages(('tor', 'tsocks','libgmp3-dev'))
+        # The rendezvous host clears out the old exchange files and starts
+        # the rendezvous before the slow provisioning and deploy below, so
+        # the other authorities find it up when they publish. They only
+        # write the dirfile after giving up on it, so nothing is lost to
+        # the reset.
+        if self.directory and testbed.nodename == self.rendezvous_host():
+            self.remove_if_exists(self.dirline_file)
+            self.remove_if_exists(self.dirline_lock)
+            self.remove_if_exists(self.dirline_sem)
+            self.start_rendezvous()
+
+        provision.ensure(self.log, testbed.experiment, deb_dirs=self.pkg_cache)
         #Make sure nothing is running after the package is started
         self.stop_tor(force=True)
 
         try:
-            self.simple_run("sudo rm -rf %s" % self.DATA_DIR)
-            self.simple_run("sudo mkdir -p %s" % self.DATA_DIR)
-            self.simple_run("sudo chown -R root:root %s" % self.DATA_DIR)
-            self.simple_run("sudo chown -R root:root %s" % self.CONTROL_DIR)
-        except Exception as e:
-            self.log.error("Error setting permissions on data directory %s" % self.DATA_DIR)
+            seconds = fsreset.reset(self.DATA_DIR)
+            fsreset.chown_tree(self.CONTROL_DIR)
+        except OSError as e:
+            self.log.error("Error resetting data directory %s: %s" % (self.DATA_DIR, e))
             raise
+        self.log.info("Reset %s in %.3f seconds" % (self.DATA_DIR, seconds))
 
         if self.tor_binary:
-            copied = False
-            attempts = 25
-            self.log.info("Replacing %s with %s" % (self.TOR_BIN, self.tor_binary))
-            while not copied and attempts > 0:
-                try:
-                    shutil.copy2(self.TOR_BIN,"/tmp/tor_bin")
-                    shutil.copy(self.tor_binary,self.TOR_BIN)
-                    shutil.copystat("/tmp/tor_bin",self.TOR_BIN)
-                    copied = True
-                except IOError as (errno,strerr):
-                    self.log.info("Error copying tor binary (%s: %s)" %(errno,strerr) )
-                    if errno == 26:
-                        self.stop_tor(force=True)
-                    attempts -= 1
-                    time.sleep(2)
+            self.log.info("Deploying %s as %s" % (self.tor_binary, self.TOR_BIN))
+            try:
+                result = deploy.install(self.tor_binary, self.TOR_BIN, self.log)
+            except deploy.DeployError as e:
+                self.log.error(str(e))
+                raise
+            self.log.info("Tor binary deployment: %s" % result)
+            self.deploy_result = result
         if self.clients and self.clients.myNodeMemberOf():
             try:
-                shutil.copy("%s/tsocks.conf" % self.template_dir, "/etc/tsocks.conf")
+                torrc.write_if_changed("/etc/tsocks.conf", self.templates.read("%s/tsocks.conf" % self.template_dir))
             except Exception as e:
                 self.log.info("Failed to copy tsocks config file: %s" % e)
 
         if(self.directory and self.directory.myNodeMemberOf()):
             #if a directory, also write the directory config
-            try:
-                import flufl.lock
-            except ImportError:
-                sys.path.append("/opt/local/egg/flufl-lock.egg")
-                import flufl.lock
-
-            self.dirline_mutex = flufl.lock.Lock(self.dirline_lock)
-            address = self.get_ip_address()
-
-            self.write_config("torrc-directory.template", self.TOR_RC, ip_address=address,extra_options="")
+            self.dirline_mutex = self.new_dirline_mutex()
             self.log.info("  Setup Directory")
         
         self.log.info("Setup Complete")
@@ -349,60 +492,82 @@ class TorAgent(Agent):
 
     def handleSEND_CTRL_MSG(self):
         """ Send a message to the control port of selected Tor instances """
+        self.apply_bundle()
 
-        if not self.ctl_dst.myNodeMemberOf():
+        if self.ctl_dst is not None and not self.ctl_dst.myNodeMemberOf():
             return
         if self.ctl_dst and self.ctl_msg :
             self.log.info("Sending control message to selected Tor nodes")
-            #if not self.isSetup():
-            #    self.log.warning("Tor not setup. Cannot send control port messages")
-            #    return
 
-            self.log.warning("Looking for the control port")
-            controlPort = None
-            controlAddr = None
-            
-            f = open(self.TOR_RC,'r')
-            for line in f:
-                if line.startswith("ControlPort"):
-                    controlPort = line.split()[1]
-                if line.startswith("ControlListenAddress"):
-                    controlAddr = line.split()[1]
-
-            if controlPort is None:
-                self.log.warning("%s is not running a control port" % (testbed.getNodeName()))
-                return
-            
-            if controlAddr is None:
-                controlAddr = '127.0.0.1'
-            try: 
-                child = pexpect.spawn('nc %s %s' % (controlAddr, controlPort))
-                child.sendline('authenticate ""')
-                exp_result = child.expect(['250 OK',pexpect.EOF,pexpect.TIMEOUT])
-                if exp_result == 1:
-                    raise Exception("Pexpect ended with EOF")
-                elif exp_result == 2:
-                    raise Exception("Pexpect timed out")
-
-                child.sendline('%s' % (self.ctl_msg))
-                i = child.expect(['2\d\d [\d\w]+','[56]\d\d [\d\w]+'])
-                if i==0:
-                    self.log.info('Response: %s',child.after)
-                    child.close()
-                else: 
-                    child.close()
-                    raise Exception("Command failed: %s " % (child.before))
+            commands = control.split_commands(self.ctl_msg)
+            try:
+                replies = self.control_batch(commands)
             except Exception as e:
                 self.log.warning("Unable to send control port message: %s" % e)
                 return
 
+            for (command, reply) in zip(commands, replies):
+                if reply.ok():
+                    self.log.info("Response to '%s': %s" % (command, reply))
+                else:
+                    self.log.warning("Command '%s' failed (%s): %s" % (command, reply.status, reply))
+
         else:
             self.log.warning("Need both destination and message to send control port message. (dest: %s, msg: %s" %(self.ctl_dst, self.ctl_msg))
 
+    def report(self, kind, data=None, tag=None):
+        """Tell the ExperimentRunner collector about something, if there is one.
+           Reports are tagged with run_tag unless told otherwise"""
+        if not self.collector:
+            return
+        if tag is None:
+            tag = self.run_tag
+        try:
+            collector.report(self.collector, kind, testbed.nodename, data, tag=tag)
+        except collector.CollectorError as e:
+            self.log.warning(str(e))
+
+    def apply_bundle(self):
+        """Apply a newer variable bundle, if one was sent, and acknowledge it"""
+        try:
+            applied = bundle.apply(self, testbed.nodename)
+        except bundle.BundleError as e:
+            self.log.error(str(e))
+            return
+        if applied is not None:
+            (version, tag) = applied
+            self.set_dirline_paths()
+            self.report('bundle', {'version': version}, tag=tag)
+
+    def handleAPPLY(self):
+        """Apply the variable bundle now rather than at the next command"""
+        self.apply_bundle()
+
+    def handleQUERY_CTRL(self):
+        """ Send ctl_msg to our control port and report the full responses
+            to the collector, tagged with our node name """
+        self.apply_bundle()
+
+        if not (self.ctl_dst and self.ctl_dst.myNodeMemberOf()):
+            return
+        if not self.ctl_msg or not self.collector:
+            self.log.warning("QUERY_CTRL needs both a message and a collector (msg: %s, collector: %s)" % (self.ctl_msg, self.collector))
+            return
+
+        commands = control.split_commands(self.ctl_msg)
+        try:
+            replies = [{'status': r.status, 'lines': r.lines} for r in self.control_batch(commands)]
+        except Exception as e:
+            self.log.warning("Unable to query control port: %s" % e)
+            replies = [{'status': 0, 'lines': ["error: %s" % e]}]
+
+        self.report('ctl', replies, tag=self.ctl_msg)
+
     def handleSAVE_DATA(self):
         """Save log data from the tor instances to the directory 
            specified by the 'save_data_dir' directory. Will not do anything if Tor
            is running."""
+        self.apply_bundle()
 
         is_client = (self.clients and self.clients.myNodeMemberOf())
         is_dir = (self.directory and self.directory.myNodeMemberOf())
@@ -417,11 +582,66 @@ class TorAgent(Agent):
         if not self.save_data_dir or not os.path.exists(self.save_data_dir):
             raise Exception("SAVE_DATA command requires 'save_data_dir' to be specified and valid")
 
+        path = self.save_path or self.results_path()
+        shipped = self.finish_shipper()
+
+        if self.save_mode == 'copy':
+            saved = self.copy_data(path)
+        else:
+            saved = self.archive_data(path, shipped)
+        self.save_path = None
+        self.report('save', saved)
+
+    def results_path(self):
+        """Where this node's results for the current run go"""
         ts = time.gmtime()
         minute_round = (ts[4]/5) * 5 if ts[4] != 0 else 0
         timesecs = time.mktime((ts[0],ts[1],ts[2],ts[3],minute_round + 5,0,ts[6],ts[7],ts[8]))
-        path = "%s/%s/%s/%s" % (self.save_data_dir,testbed.experiment,int(timesecs),testbed.getNodeName())
+        if self.run_tag:
+            return "%s/%s/%s/%s/%s" % (self.save_data_dir,testbed.experiment,self.run_tag,int(timesecs),testbed.getNodeName())
+        return "%s/%s/%s/%s" % (self.save_data_dir,testbed.experiment,int(timesecs),testbed.getNodeName())
+
+    def start_shipper(self):
+        """Start shipping logs to the results location in the background"""
+        self.finish_shipper()
+        if not self.ship_interval or not self.save_data_dir:
+            return
 
+        self.save_path = self.results_path()
+        tail = self.ship_tail or [self.TOR_LOG, "%s/*.log" % self.DATA_DIR]
+        dest = "%s.shipped" % self.save_path
+        self.shipper = shipper.Shipper(dest, tail, self.ship_snapshot, self.log, self.ship_interval)
+        self.shipper.start()
+        self.log.info("Shipping %s to %s every %s seconds" % (",".join(tail), dest, self.ship_interval))
+
+    def finish_shipper(self):
+        """Stop the shipper, flushing what's left. Returns the paths it shipped"""
+        if self.shipper is None:
+            return []
+        shipped = self.shipper.finish()
+        self.shipper = None
+        return shipped
+
+    def archive_data(self, path, shipped=()):
+        """Stream everything we save into a single compressed archive"""
+
+        delay = archive.stagger(testbed.nodename, self.tor_nodes(), self.save_stagger)
+        if delay > 0:
+            self.log.info("Waiting %.1f seconds for our upload slot" % delay)
+            time.sleep(delay)
+
+        members = [(self.DATA_DIR, ''),
+                   (self.TOR_LOG, 'log'),
+                   (self.TOR_RC, 'torrc'),
+                   ("/local/logs/daemon.log", 'daemon.log')]
+        dest = "%s.tar.gz" % path
+        (size, seconds, count) = archive.write(dest, members, self.save_include, self.save_exclude,
+                                               self.save_rate, skip=shipped)
+        self.log.info("Saved %d files to %s (%d bytes in %.2f seconds)" % (count, dest, size, seconds))
+        return {'path': dest, 'bytes': size, 'seconds': seconds, 'files': count}
+
+    def copy_data(self, path):
+        """Copy the data directory and logs to path file by file"""
         failed = False
         try:
             shutil.copytree(self.DATA_DIR,path)
@@ -448,41 +668,60 @@ class TorAgent(Agent):
             raise Exception ("Failed to copy all items")
 
         self.log.info("Copied %s to %s" % (self.DATA_DIR, path))
+        return {'path': path}
+
+    def handleGEN_KEYS(self):
+        """Generate (or check) this authority's cached keys ahead of START, so
+           every authority does its key generation in parallel"""
+        self.apply_bundle()
+
+        if not (self.directory and self.directory.myNodeMemberOf()):
+            return
+
+        started = time.time()
+        try:
+            keys = self.get_key_store().ensure(testbed.experiment, testbed.nodename)
+        except Exception as e:
+            self.log.error("Failed to generate authority keys: %s" % e)
+            return
+        self.log.info("Authority keys ready in %s (%.1f seconds)" % (keys.path, time.time() - started))
+        self.report('keys', {'seconds': time.time() - started})
 
     def handleRM_CACHE(self):
         """Cleanup the relay's history by removing log files, cached descriptors, etc in the 
            data directory. If Tor is running, don't do anything"""
+        self.apply_bundle()
+
+        if not self.in_network():
+            return
 
         if (self.isRunning()):
             raise Exception("You really dont' want to clean the directory with Tor running")
 
         if not os.path.exists(self.DATA_DIR):
             self.log.info("No data directory to clean. Exiting")
+            self.report('clean', {'seconds': 0})
             return
 
-        failed = list()
-        for cachefile in self.TOR_CACHE['files']:
-            try:
-                os.remove("%s/%s" %(self.DATA_DIR,cachefile))
-            except OSError:
-                failed.append(cachefile)
-        
-        for cachedir in self.TOR_CACHE['dirs']:
-            try:
-                shutil.rmtree("%s/%s" % (self.DATA_DIR,cachedir))
-            except (shutil.Error, OSError):
-                failed.append(cachedir)
+        # Everything but the cache is carried over into the fresh directory
+        cache = self.TOR_CACHE['files'] + self.TOR_CACHE['dirs']
+        keep = [name for name in os.listdir(self.DATA_DIR) if name not in cache]
+        seconds = fsreset.reset(self.DATA_DIR, keep=keep)
 
         try:
             os.remove("%s" % self.TOR_LOG)
         except OSError:
-            failed.append(self.TOR_LOG)
+            self.log.debug("Failed to remove %s" % self.TOR_LOG)
 
-        self.log.debug("Failed to remove %s" %(','.join(failed)))
-        self.log.info("Removed Tor Cache files")
+        self.log.info("Removed Tor Cache files in %.3f seconds" % seconds)
+        self.report('clean', {'seconds': seconds})
 
     def handleSTART(self):
         """ Handle the start message """
+        self.apply_bundle()
+
+        if not self.in_network():
+            return
 
         if(self.isRunning()):
                self.log.info("Already running")
@@ -506,13 +745,16 @@ class TorAgent(Agent):
         if(self.clients and self.clients.myNodeMemberOf()):
             self.log.info("Client")
             self.clientExec()
+
+        self.start_shipper()
     
     def handleHUP(self):
         """ Handle the Hup message """
+        self.apply_bundle()
         if self.isRunning():
             self.log.info("Hupping")
             try:
-                self.simple_run("sudo kill -s SIGHUP %s" % (self.tor_pid))
+                self.tor.signal(signal.SIGHUP)
             except Exception as e:
                 self.log.error("Failed to HUP: %s" % e)
         else:
@@ -520,12 +762,19 @@ class TorAgent(Agent):
 
     def handleKILL(self):
         """Handle the KILL message by killing Tor"""
-        self.stop_tor(force=True)
+        self.apply_bundle()
+        if not self.in_network():
+            return
+        # With other Tor networks running alongside ours, only kill our own
+        self.stop_tor(force=True, strays=(self.pools or 1) <= 1)
         self.beenSetup = False
         self.log.info("Killed") 
     
     def handleSTOP(self):
         """ Handle the Stop message """
+        self.apply_bundle()
+        if not self.in_network():
+            return
         self.log.info("Stopping")
   
         #  Getting rid of our Kludgy hack file
@@ -548,6 +797,7 @@ class TorAgent(Agent):
                 self.log.info("Exception when removing dirline_sem: %s" % e)
                 pass
 
+        self.stop_rendezvous()
         self.stop_tor()
         self.beenSetup = False
         self.log.info("Stopped")
@@ -563,8 +813,10 @@ class TorAgent(Agent):
         else:
             opts = ""
 
-        self.write_config("torrc-relay.template", self.TOR_RC, ip_address=address, directory_line=dirline,extra_options=opts)
-        self.restart_tor()
+        changed = self.write_config("torrc-relay.template", self.TOR_RC, ip_address=address, directory_line=dirline,extra_options=opts)
+        if changed or not self.isRunning():
+            self.restart_tor()
+        self.wait_until_ready(100)
         self.log.info("  Relay Done")
 
     def clientExec(self):
@@ -578,9 +830,10 @@ class TorAgent(Agent):
         else:
             opts = "" 
 
-        self.write_config("torrc-client.template", self.TOR_RC, ip_address=address, directory_line=dirline,extra_options=opts)
-
-        self.restart_tor()
+        changed = self.write_config("torrc-client.template", self.TOR_RC, ip_address=address, directory_line=dirline,extra_options=opts)
+        if changed or not self.isRunning():
+            self.restart_tor()
+        self.wait_until_ready(100)
         self.log.info("  Client Done")
 
     def directoryExec(self):
@@ -589,79 +842,22 @@ class TorAgent(Agent):
 
         self.stop_tor()
 
-        #Fix for data directory issues. Starting Tor forces it to create the 
-        # data directory.
-        self.start_tor()
-        self.stop_tor()
-
-        # Key Directory
-
+        # Install our cached keys (generating them the first time) and
+        # read the identities straight from the key files.
         keydir = self.DATA_DIR + "/keys"
 
         try:
-            if os.path.exists(keydir):
-                self.log.info("Removing old key directory %s" % keydir)
-                shutil.rmtree(keydir)
-
-            self.log.info("Creating key directory %s" % keydir)
-            os.mkdir(keydir)
-        except Exception as e:
-            self.log.error("Failed to create key directory: %s" % str(e))
-            
-        # Create Identity Key
-        self.log.info("Creating directory server identity key")
-
-        try:
-            cmd = "%s --create-identity-key" % self.TOR_GENCERT
-
-            self.log.info("Calling %s in %s" % (cmd, keydir))
-
-            child = pexpect.spawn(cmd, cwd=keydir)
-    
-            child.expect("Enter PEM pass phrase:", timeout=120)
-            child.sendline("asdf")
-            child.expect("Verifying - Enter PEM pass phrase:", timeout=120)
-            child.sendline("asdf")
-            
-            # If we don't wait for EOF, we get no keys!
-            child.expect(pexpect.EOF)
-
+            keys = self.get_key_store().ensure(testbed.experiment, testbed.nodename)
+            self.log.info("Installing authority keys from %s into %s" % (keys.path, keydir))
+            keys.install(keydir)
         except Exception as e:
-            self.log.error("Failed to generate directory server identity key: %s" % str(e))
+            self.log.error("Failed to set up directory server keys: %s" % str(e))
             sys.exit(1)
 
-        self.log.info("Setting %s to ownership by user root." % keydir)
-        
- 
-        #:wGet the directory server fingerprint
-        # tor --quiet --list-fingerprint --DataDirectory /var/lib/tor -f /etc/tor/torrc
-        self.write_config("torrc-directory.template", self.TOR_RC, ip_address=address,extra_options="")
-        self.log.info("Getting directory server fingerprint")
-        try:
-            if self.env_var_export is not None and len(self.env_var_export) > 0:
-                cmd = 'sudo'
-                for var in self.env_var_export:
-                    cmd += " %s" %var
-                cmd += " %s --quiet --list-fingerprint -f %s " %(self.TOR_BIN,self.TOR_RC)
-            else:
-                cmd = "sudo tor --quiet --list-fingerprint -f %s" % self.TOR_RC
-            (nodename, fingerprint) = self.simple_run(cmd).strip().split(' ', 1)
-        except Exception as e:
-            self.log.error("Failed to obtain fingerprint: %s" % e)
-            raise
+        fingerprint = keys.fingerprint
+        v3ident = keys.v3ident
         self.log.info("Server fingerprint is: %s" % fingerprint)
-   
-        # Get the v3ident fingerprint from DATA_DIR/keys/authority_certificate
-        #
-        
-        try:
-            authority_certificate = open("%s/keys/authority_certificate" % self.DATA_DIR).read()
-            regex = re.compile("fingerprint (\w+)", re.MULTILINE)
-            match = regex.search(authority_certificate)
-            v3ident = match.group(1)
-        except Exception as e:
-            self.log.error("Failed to find v3ident fingerprint: %s" % str(e))
-            sys.exit(1)
+        self.log.info("Server v3ident is: %s" % v3ident)
 
         # Save Directory information
     
@@ -672,9 +868,35 @@ class TorAgent(Agent):
         dir_line = "DirServer %s v3ident=%s orport=%s %s:%s %s" % (name, v3ident, "9001", address, "5000", fingerprint)
 
 
-        #HUGE HACK
-        #Pass Directory information to other nodes via shared file
-        # Should be done via messaging.
+        # Only fall back to the dirfile if the rendezvous can't be reached.
+        # It merges the dirfile's lines, and writes the whole set there once
+        # it has them, so either channel ends up with every line.
+        try:
+            self.log.info("Publishing dirline to rendezvous at %s" % self.rendezvous_host())
+            rendezvous.publish(self.rendezvous_address(), name, dir_line)
+        except (rendezvous.RendezvousError, socket.error) as e:
+            self.log.warning("Directory rendezvous publish failed, falling back to %s: %s" % (self.dirline_file, e))
+            self.publish_directory_line_file(dir_line)
+
+        # Get everyone elses dir info and change config file
+        dirline2 = self.get_directory_line()
+
+        if self.relay_config_list is not None and len(self.relay_config_list) > 0:
+            opts = "\n".join(self.relay_config_list)
+        else:
+            opts = "" 
+
+        self.write_config("torrc-multidirectory.template", self.TOR_RC, ip_address=address, directory_line=dirline2,extra_options=opts)
+
+        # Start Tor. Authorities can't bootstrap until they have all voted,
+        # so just wait for it to come up.
+        self.start_tor()
+        self.wait_until_ready(0)
+
+        self.log.info("Directory Server UP")
+
+    def publish_directory_line_file(self, dir_line):
+        """Pass Directory information to other nodes via shared file"""
 
         try:
             self.log.info("Acquiring dirline lock")
@@ -722,21 +944,3 @@ class TorAgent(Agent):
                    
         except Exception as e:
             self.log.error("Problem with DIR File: %s" % str(e))
-        
-
-        # Get everyone elses dir info and change config file
-        dirline2 = self.get_directory_line()
-
-        if self.relay_config_list is not None and len(self.relay_config_list) > 0:
-            opts = "\n".join(self.relay_config_list)
-        else:
-            opts = "" 
-
-        self.write_config("torrc-multidirectory.template", self.TOR_RC, ip_address=address, directory_line=dirline2,extra_options=opts)
-
-        # Start Tor
-        self.start_tor()
-
-        self.log.info("Directory Server UP")
-
-